@@ -0,0 +1,296 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import os
+import sys
+import time
+import subprocess
+import ConfigParser
+from optparse import OptionParser
+
+import mcuctrl
+
+__author__ = mcuctrl.__author__
+__copyright__ = mcuctrl.__copyright__
+__license__ = mcuctrl.__license__
+__version__ = mcuctrl.__version__
+
+MCUCTRL = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mcuctrl.py')
+
+
+def reset_bus():
+    '''
+    Forget all simulated MCUs, so every benchmark starts from
+    power-on register values.
+    '''
+    mcuctrl.SimulatedBus.devices.clear()
+
+
+def make_target(**overrides):
+    '''
+    Return a MCUTarget using the simulated bus, with settings from
+    mcuctrl.conf overridden by keyword arguments.
+    '''
+    settings = mcuctrl.__mcu_settings__
+    options = {}
+    for name in settings.target_options:
+        options[name] = getattr(settings, name)
+    options.update(overrides)
+    return mcuctrl.MCUTarget(mcuctrl.TargetSettings('bench', options),
+                             mcuctrl.BusLock(options['mcu_bus'], ''), os.getpid())
+
+
+def bench_cycle(name, cycles, poke=None, **overrides):
+    '''
+    Return average bus transactions per daemon poll. If poke is
+    given, that register is changed behind the daemons back before
+    every poll, forcing corrective meassures.
+    '''
+    reset_bus()
+    target = make_target(check_interval=3600, firmware_interval=0, **overrides)
+    mcu = target.open()
+    # first poll brings the simulated MCU in line with the config
+    deadline = target.poll()
+    device = mcu.bus.device(target.address)
+    stats = mcuctrl.__mcu_stats__
+    stats.reset()
+    # every cycle is run at the next deadline of the scheduler
+    for i in range(cycles):
+        if poke is not None:
+            device.poke(poke[0], poke[1])
+        deadline = target.poll(deadline)
+    return float(stats.total()) / cycles
+
+
+def bench_command(command, runs):
+    '''
+    Return (min, avg, max) wall clock seconds of running command
+    '''
+    devnull = open(os.devnull, 'w')
+    times = []
+    try:
+        for i in range(runs):
+            start = time.time()
+            status = subprocess.call(command, stdout=devnull, stderr=devnull)
+            times.append(time.time() - start)
+            if status != 0:
+                raise RuntimeError('%s exited with status %d' % (' '.join(command), status))
+    finally:
+        devnull.close()
+    return min(times), sum(times) / len(times), max(times)
+
+
+def bench_cli(args, runs, script=MCUCTRL):
+    '''
+    Return (min, avg, max) wall clock seconds of mcuctrl.py runs
+    '''
+    return bench_command([sys.executable, script, '--backend', 'sim',
+                          '-b', '0', '-a', '0x34'] + args, runs)
+
+
+def bench_startup(runs, script=MCUCTRL):
+    '''
+    Return list of (name, (min, avg, max)) for interpreter startup
+    and for importing mcuctrl as a library.
+    '''
+    load = 'import imp; imp.load_source("mcuctrl", %r)' % script
+    return [('python_startup', bench_command([sys.executable, '-c', 'pass'], runs)),
+            ('import', bench_command([sys.executable, '-c', load], runs))]
+
+
+def bench_writes(writes, batch=False, cache_ttl=None):
+    '''
+    Return (writes per second, transactions per write) for repeated
+    brightness writes.
+    '''
+    reset_bus()
+    mcu = mcuctrl.MCUControl(0, '34', cache_ttl=cache_ttl, backend='sim')
+    stats = mcuctrl.__mcu_stats__
+    stats.reset()
+    start = time.time()
+    if batch:
+        with mcu.batch(verify=mcuctrl.VERIFY_COMMIT) as queue:
+            for i in range(writes):
+                queue.write_byte('brightness', i % 100)
+    else:
+        for i in range(writes):
+            mcu.write_byte('brightness', i % 100)
+    elapsed = time.time() - start
+    return writes / max(elapsed, 1e-9), float(stats.total()) / writes
+
+
+def bench_snapshot(snapshots, mode):
+    '''
+    Return (snapshots per second, transactions per snapshot) for
+    reading all SNAPSHOT_REGISTERS with the given snapshot_mode.
+    '''
+    reset_bus()
+    mcu = mcuctrl.MCUControl(0, '34', backend='sim')
+    mcu.snapshot_mode = mode
+    stats = mcuctrl.__mcu_stats__
+    stats.reset()
+    start = time.time()
+    for i in range(snapshots):
+        mcu.snapshot()
+    elapsed = time.time() - start
+    return snapshots / max(elapsed, 1e-9), float(stats.total()) / snapshots
+
+
+def bench_replay(filename, speed):
+    '''
+    Return results of replaying a bus trace against the daemon
+    checks, see mcuctrl.TraceReplay
+    '''
+    records = mcuctrl.TraceFile.read(filename)
+    return mcuctrl.TraceReplay(records, mcuctrl.__mcu_settings__, speed).run()
+
+
+def run(options):
+    '''
+    Run all benchmarks. Returns dict of transaction counts, used
+    for baseline comparison.
+    '''
+    settings = mcuctrl.__mcu_settings__
+    settings._set(settings.replace(bus_backend='sim', sim_latency=options.latency))
+    pwm_min = mcuctrl.BRIGHTNESS_PWM_MIN_RW
+    counts = {}
+
+    print 'Bus transactions per daemon cycle'
+    cycles = [
+        ('cycle_full', {}),
+        ('cycle_full_cached', {'register_cache_ttl' : 3600}),
+        ('cycle_full_corrective', {'poke' : (pwm_min, 0)}),
+        ('cycle_change_idle', {'polling_mode' : 'change'}),
+        ('cycle_change_corrective', {'polling_mode' : 'change',
+                                     'poke' : (pwm_min, 0)}),
+        ('cycle_auto', {'control_mode' : 'auto'}),
+    ]
+    for name, overrides in cycles:
+        counts[name] = bench_cycle(name, options.cycles, **overrides)
+        print '  %-32s %8.2f' % (name, counts[name])
+
+    print 'Repeated writes'
+    for name, kwargs in [('write', {}),
+                         ('write_cached', {'cache_ttl' : 3600}),
+                         ('write_batch', {'batch' : True})]:
+        rate, per_write = bench_writes(options.writes, **kwargs)
+        counts[name] = per_write
+        print '  %-32s %8.2f transactions/write %10.0f writes/s' \
+              % (name, per_write, rate)
+
+    print 'Register snapshots'
+    for name, mode in [('snapshot_combined', 'combined'),
+                       ('snapshot_bytes', 'bytes')]:
+        rate, per_snapshot = bench_snapshot(options.writes, mode)
+        counts[name] = per_snapshot
+        print '  %-32s %8.2f transactions/snapshot %7.0f snapshots/s' \
+              % (name, per_snapshot, rate)
+
+    if options.replay:
+        result = bench_replay(options.replay, options.replay_speed)
+        latencies = result['latencies'] or [0.0]
+        counts['replay_transactions'] = result['transactions']
+        counts['replay_latency_max'] = max(latencies)
+        print 'Trace replay of %s' % options.replay
+        print '  %-32s %8d' % ('changes', result['changes'])
+        print '  %-32s %8d' % ('corrected', result['corrected'])
+        print '  %-32s %8d' % ('polls', result['polls'])
+        print '  %-32s %8d' % ('transactions', result['transactions'])
+        print '  %-32s %8.3f %8.3f %8.3f' \
+              % ('correction latency s min/avg/max', min(latencies),
+                 sum(latencies) / len(latencies), max(latencies))
+    
+    if options.cli_runs:
+        print 'Startup and command line latency (min/avg/max ms)'
+        results = bench_startup(options.cli_runs, options.mcuctrl)
+        for name, args in [('cli_help', ['--help']),
+                           ('cli_read', ['-r', 'brightness']),
+                           ('cli_write', ['-w', 'brightness', '20'])]:
+            results.append((name, bench_cli(args, options.cli_runs, options.mcuctrl)))
+        for name, result in results:
+            print '  %-32s %8.1f %8.1f %8.1f' \
+                  % ((name,) + tuple([t * 1000 for t in result]))
+
+    return counts
+
+
+def save_baseline(filename, counts):
+    config = ConfigParser.RawConfigParser()
+    config.add_section('transactions')
+    for name, value in sorted(counts.items()):
+        config.set('transactions', name, '%.2f' % value)
+    f = open(filename, 'w')
+    try:
+        config.write(f)
+    finally:
+        f.close()
+
+
+def check_baseline(filename, counts):
+    '''
+    Compare transaction counts to a saved baseline. Returns a list
+    of regressions.
+    '''
+    config = ConfigParser.RawConfigParser()
+    config.read(filename)
+    regressions = []
+    for name, value in config.items('transactions'):
+        if name in counts and counts[name] > float(value) + 0.005:
+            regressions.append('%s: %.2f transactions, baseline %s' \
+                               % (name, counts[name], value))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = OptionParser(description='Benchmark mcuctrl against the '
+                          'simulated bus backend.')
+    parser.add_option('--cycles', type='int', dest='cycles', default=100,
+          help='daemon cycles per benchmark [default: %default]')
+    parser.add_option('--writes', type='int', dest='writes', default=1000,
+          help='writes per throughput benchmark [default: %default]')
+    parser.add_option('--cli-runs', type='int', dest='cli_runs', default=10,
+          help='command line invocations per latency benchmark. \
+                  0 skips them [default: %default]')
+    parser.add_option('--mcuctrl', dest='mcuctrl', metavar='FILE',
+          default=MCUCTRL, help='mcuctrl.py used for the startup and \
+                  command line benchmarks, for comparing versions \
+                  [default: %default]')
+    parser.add_option('--latency', type='float', dest='latency', default=0.0,
+          help='simulated seconds per bus transaction [default: %default]')
+    parser.add_option('--replay', dest='replay', metavar='FILE',
+          help='replay a bus trace recorded by mcuctrl (trace_file or \
+                  --trace) against the daemon checks, reporting \
+                  transactions and correction latency')
+    parser.add_option('--replay-speed', type='float', dest='replay_speed',
+          default=0.0, help='replay the trace in real time, sped up this \
+                  many times. 0 replays it on a virtual clock, as fast \
+                  as possible [default: %default]')
+    parser.add_option('--save-baseline', dest='save_baseline', metavar='FILE',
+          help='save transaction counts to FILE')
+    parser.add_option('--baseline', dest='baseline', metavar='FILE',
+          help='fail if transaction counts exceed those saved in FILE')
+    (options, args) = parser.parse_args()
+
+    counts = run(options)
+    if options.save_baseline:
+        save_baseline(options.save_baseline, counts)
+    if options.baseline:
+        regressions = check_baseline(options.baseline, counts)
+        for regression in regressions:
+            print 'REGRESSION %s' % regression
+        if regressions:
+            sys.exit(1)
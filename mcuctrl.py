@@ -20,15 +20,32 @@ from __future__ import with_statement
 import os
 import sys
 import time
+import errno
+import bisect
+import copy
 import atexit
-import logging
-import ConfigParser
-from logging import handlers
-from optparse import OptionParser
-from optparse import OptionGroup
-from optparse import OptionValueError
+import select
+import socket
+import threading
+import struct
+import mmap
+import signal
 from signal import SIGTERM
-from smbus import SMBus
+from signal import SIGKILL
+from signal import SIGUSR1
+from signal import SIGHUP
+try:
+    from smbus import SMBus
+except ImportError:
+    # only needed by the smbus bus backend
+    SMBus = None
+try:
+    # smbus2 adds combined transfers, and can stand in for smbus
+    from smbus2 import i2c_msg
+    if SMBus is None:
+        from smbus2 import SMBus
+except ImportError:
+    i2c_msg = None
 
 __author__ = u'Rolf Håvard Blindheim'
 __copyright__ = 'Copyright 2011, Elektronix AS'
@@ -73,6 +90,343 @@ KEYPAD_LOCK_W = 0x21
 BRIGHTNESS_PWM_MIN_RW = 0x22
 BRIGHTNESS_PWM_MAX_RW = 0x23
 
+CONFIG_FILE = '/etc/mcuctrl.conf'
+
+# Seconds between checks of mcuctrl.conf for changes
+CONFIG_POLL_INTERVAL = 5
+
+# clock_gettime() clock id, and the clock monotonic() uses once
+# it has been looked up
+CLOCK_MONOTONIC = 1
+MONOTONIC_CLOCK = []
+
+# Seconds stop waits for the daemon to exit before killing it
+STOP_TIMEOUT = 10
+
+# Number of MCUs the daemon can publish register values of in
+# state_file
+STATE_SLOTS = 32
+
+# Check intervals after which --cached refuses a published value,
+# the daemon having stopped refreshing it
+STATE_MAX_AGE = 3
+
+# Shadow register cache policies used by MCUControl.
+#
+# CACHE_NEVER:  volatile registers, always read from the bus
+# CACHE_TTL:    config-like registers, served from the shadow map
+#               until register_cache_ttl seconds have passed
+# CACHE_STATIC: registers that never change while the MCU is powered
+CACHE_NEVER = 0
+CACHE_TTL = 1
+CACHE_STATIC = 2
+
+# Names of the cache policies in model profile files
+CACHE_POLICIES = {
+    'never' : CACHE_NEVER,
+    'ttl' : CACHE_TTL,
+    'static' : CACHE_STATIC
+}
+
+# Registers of the AFL-408B MCU, the builtin model profile.
+#
+# name, read command, write command, minimum and maximum value written,
+# cache policy of reads, and the register a write command changes by
+# an amount we can not predict. Brightness and volume can be changed by
+# the remote control behind our back, so they are never cached.
+AFL_408B_REGISTERS = (
+    ('brightness', BRIGHTNESS_R, BRIGHTNESS_W, 0, 255, CACHE_NEVER, None),
+    ('volume', VOLUME_R, VOLUME_W, 0, 255, CACHE_NEVER, None),
+    ('inc_brightness', None, INCREASE_BRIGHTNESS_W, 0, 255, CACHE_NEVER, 'brightness'),
+    ('dec_brightness', None, DECREASE_BRIGHTNESS_W, 0, 255, CACHE_NEVER, 'brightness'),
+    ('inc_volume', None, INCREASE_VOLUME_W, 0, 255, CACHE_NEVER, 'volume'),
+    ('dec_volume', None, DECREASE_VOLUME_W, 0, 255, CACHE_NEVER, 'volume'),
+    ('mute', None, MUTE_W, 0, 255, CACHE_NEVER, 'volume'),
+    ('inverter', None, INVERTER_W, 0, 255, CACHE_NEVER, None),
+    ('fw', FW_VERSION_R, None, 0, 255, CACHE_STATIC, None),
+    ('flag', FLAG_R, None, 0, 255, CACHE_NEVER, None),
+    ('polling', None, POLLING_W, 0, 255, CACHE_NEVER, None),
+    ('backlight', BACKLIGHT_R, BACKLIGHT_W, 0, 255, CACHE_TTL, None),
+    ('auto_dimming', None, AUTO_DIMMING_W, 0, 255, CACHE_NEVER, 'brightness'),
+    ('fwtype', FW_TYPE_R, None, 0, 255, CACHE_STATIC, None),
+    ('rdname', RD_NAME_R, None, 0, 255, CACHE_STATIC, None),
+    ('function', FUNCTION_R, None, 0, 255, CACHE_STATIC, None),
+    ('luxmode', LUX_MODE_R, LUX_MODE_W, 0, 255, CACHE_TTL, None),
+    ('change_status', CHANGE_STATUS_R, None, 0, 255, CACHE_NEVER, None),
+    ('keypad_lock', None, KEYPAD_LOCK_W, 0, 255, CACHE_NEVER, None),
+    ('pwm_min', BRIGHTNESS_PWM_MIN_RW, BRIGHTNESS_PWM_MIN_RW, 0, 255, CACHE_TTL, None),
+    ('pwm_max', BRIGHTNESS_PWM_MAX_RW, BRIGHTNESS_PWM_MAX_RW, 0, 255, CACHE_TTL, None)
+)
+
+# Register names used by the daemon, which every model profile must
+# be able to read and write, and those it must be able to read.
+# change_status and luxmode are only needed in change polling and
+# auto control mode, see TargetSettings.
+REQUIRED_REGISTERS = ('brightness', 'pwm_min', 'pwm_max')
+REQUIRED_READ_REGISTERS = ('fw', 'fwtype')
+
+# Registers read by MCUControl.snapshot() by default
+SNAPSHOT_REGISTERS = ('brightness', 'volume', 'fw', 'fwtype', 'flag',
+                      'backlight', 'luxmode', 'change_status',
+                      'pwm_min', 'pwm_max')
+
+# Telemetry record flags
+TELEMETRY_CORRECTIVE = 0x01     # value was out of threshold
+TELEMETRY_WRITE = 0x02          # value was written, not read
+
+# Bus trace record operations
+TRACE_READ = 1                  # read_byte_data
+TRACE_WRITE = 2                 # write_byte_data
+TRACE_RDWR = 3                  # one command of a combined read
+
+# Published register value flags
+STATE_VALID = 0x01              # value is current, not invalidated
+
+# Bus lock priorities, see BusLock
+PRIORITY_INTERACTIVE = 0        # command line and control socket
+PRIORITY_BACKGROUND = 1         # daemon checks
+LOCK_PRIORITIES = {PRIORITY_INTERACTIVE : 'interactive',
+                   PRIORITY_BACKGROUND : 'background'}
+
+# PWM range verification policies for MCUControl.batch()
+#
+# VERIFY_ALWAYS: verify after every queued write
+# VERIFY_COMMIT: verify once, after all queued writes are issued
+# VERIFY_NEVER:  do not verify
+VERIFY_ALWAYS = 'always'
+VERIFY_COMMIT = 'commit'
+VERIFY_NEVER = 'never'
+
+# Bus errors worth retrying: lost arbitration, a busy adapter,
+# timeouts, and NACKs from a device which is busy or being reset
+TRANSIENT_ERRNOS = (errno.EIO, errno.EAGAIN, errno.EBUSY, errno.EINTR,
+                    errno.ETIMEDOUT, errno.ENXIO, errno.EREMOTEIO)
+
+# Bus errors after which the bus handle is closed, and reopened on
+# the next transaction
+REOPEN_ERRNOS = (errno.EBADF, errno.ENODEV, errno.ENOENT)
+
+# Sections reported by Profiler.summary(), and the functions whose
+# cumulative time they are made of
+PROFILE_SECTIONS = (
+    ('config parse', ('MCUSettings.read_config', 'MCUSettings._load')),
+    ('logger setup', ('MCUSettings.get_logger',)),
+    ('bus open', ('open_bus',)),
+    ('read_byte_data', ('InstrumentedBus.read_byte_data',)),
+    ('read_byte_data_combined', ('InstrumentedBus.read_byte_data_combined',)),
+    ('write_byte_data', ('InstrumentedBus.write_byte_data',)),
+    ('logging', ('QueuedLogger.log', 'QueuedLogger.write'))
+)
+
+# Valid loglevel values, mapped to logging level names
+LOG_LEVELS = {
+    'debug' : 'DEBUG',
+    'info' : 'INFO',
+    'warning' : 'WARNING',
+    'warn' : 'WARNING',
+    'error' : 'ERROR',
+    'critical' : 'CRITICAL'
+}
+
+
+class SettingsError(ValueError):
+    '''
+    Raised for invalid values in mcuctrl.conf
+    '''
+    pass
+
+
+class BusError(IOError):
+    '''
+    Raised when a bus transaction fails, after retries if the error
+    was transient. transient is False for errors retrying can not
+    fix, like a missing adapter or smbus module.
+    '''
+    def __init__(self, err, strerror, transient=False):
+        IOError.__init__(self, err, strerror)
+        self.transient = transient
+
+
+class Register(object):
+    '''
+    Descriptor of one named MCU register or command. read and write
+    are the command bytes, None if it can not be read or written.
+    Values written must be within minimum and maximum. cache is the
+    shadow register cache policy of reads. A write command with
+    affects set changes that register by an amount we can not
+    predict, and invalidates its shadow value.
+    '''
+    def __init__(self, name, read=None, write=None, minimum=0, maximum=0xff,
+                 cache=CACHE_NEVER, affects=None):
+        self.name = name
+        self.read = read
+        self.write = write
+        self.minimum = minimum
+        self.maximum = maximum
+        self.cache = cache
+        self.affects = affects
+
+
+class MCUProfile(object):
+    '''
+    Register set of one MCU model. The lookup tables MCUControl uses
+    for dispatch and validation are built once, here:
+    
+        read_commands:     name to read command byte
+        write_commands:    name to (write command byte, minimum, maximum)
+        cache_policy:      read command byte to cache policy
+        shadow_write:      write command byte to the read command byte
+                           it can be read back through (write-through)
+        shadow_invalidate: write command byte to the read command
+                           byte whose shadow value it invalidates
+        ramp_commands:     write command bytes which change brightness,
+                           and cancel a fade
+    '''
+    def __init__(self, name, registers):
+        self.name = name
+        self.registers = {}
+        self.read_commands = {}
+        self.write_commands = {}
+        self.cache_policy = {}
+        self.shadow_write = {}
+        self.shadow_invalidate = {}
+        for register in registers:
+            self.registers[register.name] = register
+            if register.read is not None:
+                self.read_commands[register.name] = register.read
+                self.cache_policy[register.read] = register.cache
+            if register.write is not None:
+                self.write_commands[register.name] = (register.write,
+                        register.minimum, register.maximum)
+        
+        for register in registers:
+            if register.write is None:
+                continue
+            if register.read is not None:
+                self.shadow_write[register.write] = register.read
+            elif register.affects is not None:
+                affected = self.registers.get(register.affects)
+                if affected is None or affected.read is None:
+                    raise ValueError('%s: %s affects unknown register %s' \
+                                     % (name, register.name, register.affects))
+                self.shadow_invalidate[register.write] = affected.read
+        
+        for required in REQUIRED_REGISTERS:
+            register = self.registers.get(required)
+            if register is None or register.read is None or register.write is None:
+                raise ValueError('%s: register %s must be readable and writable' \
+                                 % (name, required))
+        for required in REQUIRED_READ_REGISTERS:
+            if required not in self.read_commands:
+                raise ValueError('%s: register %s must be readable' % (name, required))
+        self.ramp_commands = [self.registers['brightness'].write]
+        for command in ('inc_brightness', 'dec_brightness'):
+            if command in self.write_commands:
+                self.ramp_commands.append(self.write_commands[command][0])
+    
+    def load(cls, filename):
+        '''
+        Return profile read from a model profile file. Each register
+        is a [register:<name>] section:
+        
+            [register:brightness]
+            read = 0x01
+            write = 0x08
+            range = 0-100
+            cache = never|ttl|static
+            affects = <register name>
+        
+        All options are optional. A [profile] section may name the
+        profile, and name a builtin model it extends with base. A
+        section naming a register of the base model overrides only
+        the options given. Raises IOError or ValueError.
+        '''
+        from ConfigParser import RawConfigParser, Error
+        config = RawConfigParser()
+        if not config.read(filename):
+            raise IOError(errno.ENOENT, 'could not read model profile %s' % filename)
+        
+        name = os.path.splitext(os.path.basename(filename))[0]
+        registers = {}
+        try:
+            if config.has_section('profile'):
+                if config.has_option('profile', 'name'):
+                    name = config.get('profile', 'name')
+                if config.has_option('profile', 'base'):
+                    base = config.get('profile', 'base')
+                    if base not in MCU_MODELS:
+                        raise ValueError('%s: unknown base model %s' % (filename, base))
+                    registers.update(MCU_MODELS[base].registers)
+            for section in config.sections():
+                if not section.startswith('register:'):
+                    continue
+                options = dict(config.items(section))
+                register_name = section[len('register:'):]
+                if register_name in registers:
+                    # the base model's register is shared, change a copy
+                    register = copy.copy(registers[register_name])
+                else:
+                    register = Register(register_name)
+                for option in ('read', 'write'):
+                    if option in options:
+                        value = options[option].strip()
+                        setattr(register, option, int(value, 0) if value else None)
+                if 'range' in options:
+                    low, high = options['range'].split('-')
+                    register.minimum, register.maximum = int(low, 0), int(high, 0)
+                if 'cache' in options:
+                    register.cache = CACHE_POLICIES[options['cache']]
+                if 'affects' in options:
+                    register.affects = options['affects'] or None
+                registers[register_name] = register
+        except (Error, KeyError, ValueError), e:
+            raise ValueError('%s: %s' % (filename, e))
+        return cls(name, registers.values())
+    
+    load = classmethod(load)
+
+
+# Builtin model profiles, and profile files loaded by get_profile()
+AFL_408B = MCUProfile('afl-408b', [Register(*r) for r in AFL_408B_REGISTERS])
+MCU_MODELS = {'afl-408b' : AFL_408B}
+
+
+def get_profile(model):
+    '''
+    Return MCUProfile for model, the name of a builtin model or a
+    model profile file. Profile files are only read once.
+    '''
+    if model not in MCU_MODELS:
+        MCU_MODELS[model] = MCUProfile.load(model)
+    return MCU_MODELS[model]
+
+
+def parse_address(value):
+    '''
+    Return MCU address given as a hexadecimal string, or as a number
+    '''
+    if isinstance(value, (int, long)):
+        return value
+    return int(value, 16)
+
+
+def parse_curve(value):
+    '''
+    Return brightness curve given as 'lux:brightness, ...' as a
+    sorted tuple of (lux, brightness) points
+    '''
+    if isinstance(value, tuple):
+        return value
+    points = []
+    for point in value.split(','):
+        lux, brightness = point.split(':')
+        points.append((float(lux), int(brightness)))
+    if not points:
+        raise ValueError('empty brightness curve')
+    points.sort()
+    return tuple(points)
+
+
 class MCUSettings(object):
     '''
     Class for overriding default settings from config file
@@ -87,13 +441,143 @@ class MCUSettings(object):
         default_brightness:      Brightness level daemon should
                                  set
         check_interval:          Interval in seconds between each
-                                 check
+                                 check of the PWM thresholds
+        brightness_interval:     Seconds between brightness samples
+                                 recorded in telemetry. 0 disables
+                                 them
+        firmware_interval:       Seconds between reading firmware
+                                 version and type again, to notice a
+                                 replaced or reflashed MCU. 0 only
+                                 reads them at start
         pidfile:                 Location of program pidfile
-        logfile:                 Location of program logfile
+        logfile:                 Location of program logfile.
+                                 Empty disables logging
         logrotate_backoup_count: How many backups to keep
         logfile_max_size:        Max size in bytes before rotating
                                  logfiles
         loglevel:                debug|info|warning|error|critical
+        log_queue_size:          Log records queued for the log
+                                 writer thread. Records are dropped
+                                 rather than delaying the daemon
+                                 when the queue is full
+        log_repeat_interval:     Seconds an identical log message
+                                 is counted instead of written.
+                                 0 writes every message
+        register_cache_ttl:      Seconds config-like registers are
+                                 served from the shadow register
+                                 cache. 0 disables the cache. The
+                                 daemon check only uses it in change
+                                 polling mode
+        bus_backend:             smbus|sim. sim replaces the SMBus
+                                 with an in-memory simulated MCU
+        sim_latency:             Seconds each simulated bus
+                                 transaction takes
+        sim_fault_rate:          Fraction (0-1) of simulated bus
+                                 transactions failing with EIO
+        stats_file:              File bus statistics are written
+                                 to on SIGUSR1. Empty writes them
+                                 to the log instead
+        stats_interval:          Seconds between writing bus
+                                 statistics to stats_file. 0 only
+                                 writes them on SIGUSR1
+        control_socket:          Location of the daemon control
+                                 socket. Empty disables the socket
+        polling_mode:            full|change. full compares all
+                                 registers every check_interval.
+                                 change reads only the change status
+                                 register each tick, and compares
+                                 all registers when a change is
+                                 flagged or check_interval has passed
+        fast_interval:           Shortest tick in seconds in change
+                                 polling mode, used after activity
+        slow_interval:           Longest tick in seconds in change
+                                 polling mode, reached when idle
+        ramp_duration:           Seconds the daemon takes to fade
+                                 brightness to default_brightness.
+                                 0 sets it at once
+        ramp_max_rate:           Maximum bus writes per second
+                                 while fading brightness
+        brightness_step:         Brightness units one increase or
+                                 decrease brightness command moves
+        telemetry_file:          File keeping the telemetry ring
+                                 buffer of samples across restarts.
+                                 Empty keeps it in memory only
+        telemetry_capacity:      Number of samples kept in the
+                                 telemetry ring buffer, 13 bytes each
+        control_mode:            static|auto. static keeps brightness
+                                 at default_brightness after
+                                 corrective meassures. auto follows
+                                 the ambient light read from the lux
+                                 register every poll
+        lux_filter:              ema|median. Filter smoothing the
+                                 ambient light samples in auto mode
+        lux_filter_alpha:        Weight (0-1] of a new sample in the
+                                 ema filter
+        lux_filter_window:       Number of samples in the median
+                                 filter
+        brightness_curve:        lux:brightness points, separated by
+                                 commas, mapping smoothed ambient
+                                 light to brightness. Interpolated
+                                 linearly, and clamped to the PWM
+                                 thresholds
+        lux_hysteresis:          Smoothed ambient light must move
+                                 this much before brightness is
+                                 evaluated again
+        brightness_deadband:     Smallest brightness change written
+                                 in auto mode
+        bus_retries:             Times a bus transaction failing
+                                 with a transient error (EIO,
+                                 EAGAIN, EBUSY, timeout, NACK) is
+                                 retried
+        bus_retry_delay:         Seconds before the first retry.
+                                 Doubled on every retry, and
+                                 jittered
+        bus_retry_max_delay:     Longest delay between retries
+        breaker_threshold:       Failed transactions in a row after
+                                 which an MCU is left alone for
+                                 breaker_timeout seconds
+        breaker_timeout:         Seconds before an unresponsive MCU
+                                 is tried again
+        snapshot_mode:           auto|combined|bytes. How registers
+                                 read together are transferred.
+                                 combined uses one i2c_rdwr
+                                 transfer (needs smbus2), bytes one
+                                 transaction per register. auto
+                                 tries combined, and uses bytes if
+                                 the MCU does not accept it
+        mcu_model:               Name of a builtin MCU model
+                                 (afl-408b), or a model profile file
+                                 naming the registers of the MCU,
+                                 their command bytes and value
+                                 ranges. See MCUProfile.load()
+        profile_file:            File the daemon writes cProfile
+                                 statistics of its poll cycles to,
+                                 with its bus statistics. Empty
+                                 disables profiling
+        profile_every:           Profile only every n-th poll
+                                 cycle, to keep the overhead low
+        trace_file:              File every bus transaction of the
+                                 daemon is appended to, for replay
+                                 by mcubench.py. Empty disables
+                                 tracing
+        state_file:              Memory mapped file the daemon
+                                 publishes the register values it
+                                 knows in, for -r --cached and other
+                                 readers. Empty disables it
+        bus_lock_dir:            Directory of the lock files which
+                                 keep the daemon and command line
+                                 invocations from using a bus at
+                                 the same time. Empty disables
+                                 locking between processes
+        bus_lock_timeout:        Longest time in seconds to wait
+                                 for another process to release a
+                                 bus
+    
+    Several MCUs can be supervised by one daemon by adding a
+    [mcu:<name>] section per MCU. Each section may override the
+    options listed in target_options; omitted options are taken
+    from [main]. Without such sections, the MCU given in [main] is
+    supervised.
     '''
     defaults = {
         'mcu_bus' : 0,
@@ -102,74 +586,416 @@ class MCUSettings(object):
         'min_pwm_threshold' : 0,
         'default_brightness' : 20,
         'check_interval' : 300,
+        'brightness_interval' : 0,
+        'firmware_interval' : 3600,
         'pidfile' : '/var/run/mcuctrl.pid',
         'logfile' : '/var/log/mcuctrl.log',
         'logrotate_backup_count' : 5,
         'logfile_max_size' : 102400,
-        'loglevel' : 'error'
+        'loglevel' : 'error',
+        'log_queue_size' : 1000,
+        'log_repeat_interval' : 60,
+        'register_cache_ttl' : 0,
+        'bus_backend' : 'smbus',
+        'sim_latency' : 0,
+        'sim_fault_rate' : 0,
+        'stats_file' : '/var/run/mcuctrl.stats',
+        'stats_interval' : 0,
+        'control_socket' : '/var/run/mcuctrl.sock',
+        'polling_mode' : 'full',
+        'fast_interval' : 0.5,
+        'slow_interval' : 5,
+        'ramp_duration' : 0,
+        'ramp_max_rate' : 20,
+        'brightness_step' : 1,
+        'telemetry_file' : '',
+        'telemetry_capacity' : 100000,
+        'control_mode' : 'static',
+        'lux_filter' : 'ema',
+        'lux_filter_alpha' : 0.3,
+        'lux_filter_window' : 5,
+        'brightness_curve' : '0:0, 255:100',
+        'lux_hysteresis' : 2,
+        'brightness_deadband' : 3,
+        'bus_retries' : 3,
+        'bus_retry_delay' : 0.005,
+        'bus_retry_max_delay' : 0.1,
+        'breaker_threshold' : 5,
+        'breaker_timeout' : 30,
+        'snapshot_mode' : 'auto',
+        'mcu_model' : 'afl-408b',
+        'profile_file' : '',
+        'profile_every' : 1,
+        'trace_file' : '',
+        'state_file' : '/var/run/mcuctrl.state',
+        'bus_lock_dir' : '/var/run',
+        'bus_lock_timeout' : 2.0
     }
     
-    def __init__(self):
+    # conversion of config file strings to typed values
+    types = {
+        'mcu_bus' : int,
+        'mcu_address' : parse_address,
+        'max_pwm_threshold' : int,
+        'min_pwm_threshold' : int,
+        'default_brightness' : int,
+        'check_interval' : float,
+        'brightness_interval' : float,
+        'firmware_interval' : float,
+        'pidfile' : str,
+        'logfile' : str,
+        'logrotate_backup_count' : int,
+        'logfile_max_size' : int,
+        'loglevel' : str,
+        'log_queue_size' : int,
+        'log_repeat_interval' : float,
+        'register_cache_ttl' : float,
+        'bus_backend' : str,
+        'sim_latency' : float,
+        'sim_fault_rate' : float,
+        'stats_file' : str,
+        'stats_interval' : float,
+        'control_socket' : str,
+        'polling_mode' : str,
+        'fast_interval' : float,
+        'slow_interval' : float,
+        'ramp_duration' : float,
+        'ramp_max_rate' : float,
+        'brightness_step' : int,
+        'telemetry_file' : str,
+        'telemetry_capacity' : int,
+        'control_mode' : str,
+        'lux_filter' : str,
+        'lux_filter_alpha' : float,
+        'lux_filter_window' : int,
+        'brightness_curve' : parse_curve,
+        'lux_hysteresis' : float,
+        'brightness_deadband' : int,
+        'bus_retries' : int,
+        'bus_retry_delay' : float,
+        'bus_retry_max_delay' : float,
+        'breaker_threshold' : int,
+        'breaker_timeout' : float,
+        'snapshot_mode' : str,
+        'mcu_model' : str,
+        'profile_file' : str,
+        'profile_every' : int,
+        'trace_file' : str,
+        'state_file' : str,
+        'bus_lock_dir' : str,
+        'bus_lock_timeout' : float
+    }
+    
+    # options which can be set per MCU in [mcu:<name>] sections
+    target_options = (
+        'mcu_bus',
+        'mcu_address',
+        'max_pwm_threshold',
+        'min_pwm_threshold',
+        'default_brightness',
+        'check_interval',
+        'brightness_interval',
+        'firmware_interval',
+        'register_cache_ttl',
+        'polling_mode',
+        'fast_interval',
+        'slow_interval',
+        'ramp_duration',
+        'ramp_max_rate',
+        'brightness_step',
+        'control_mode',
+        'lux_filter',
+        'lux_filter_alpha',
+        'lux_filter_window',
+        'brightness_curve',
+        'lux_hysteresis',
+        'brightness_deadband',
+        'bus_retries',
+        'bus_retry_delay',
+        'bus_retry_max_delay',
+        'breaker_threshold',
+        'breaker_timeout',
+        'snapshot_mode',
+        'mcu_model'
+    )
+    
+    def __init__(self, filename=CONFIG_FILE):
         '''
         Load and override default settings from mcuctrl.conf.
         Applying default where omitted from config file.
         
-        NOTE: object attributes are not set before class is
-              initialized.
+        Values are converted and validated once. Settings are
+        read-only; use load() to read a new set of settings.
         '''
-        config = ConfigParser.RawConfigParser()
         try:
-            # make sure config file exists and is readable
-            with open('/etc/mcuctrl.conf') as f:
-                f.close()
-            
-            # read config file
-            config.read('/etc/mcuctrl.conf')
-            cfg = {}
-            for key, val in config.items('main'):
-                cfg.update({key : val})
-            
-            # replace defaults with values from config file
-            for name, default in self.defaults.iteritems():
-                value = cfg.get(name, default)
-                setattr(self, name, value)
-        except IOError, e:
-            # no use to try to log this; logger does not exist
-            print e
-            sys.exit(1)
+            self._load(filename, *self.read_config(filename))
         except Exception, e:
+            # no use to try to log this; logger needs the settings
             print e
-            __mcu_logger__.critical(e)
             sys.exit(1)
+    
+    def load(cls, filename=CONFIG_FILE):
+        '''
+        Return settings read from filename. Unlike the constructor,
+        raises IOError or SettingsError instead of exiting.
+        '''
+        settings = object.__new__(cls)
+        settings._load(filename, *cls.read_config(filename))
+        return settings
+    
+    load = classmethod(load)
+    
+    def default(cls):
+        '''
+        Return the default settings, for use without a config file.
+        Nothing is logged.
+        '''
+        settings = object.__new__(cls)
+        settings._load(CONFIG_FILE, {'logfile' : ''}, [])
+        return settings
+    
+    default = classmethod(default)
+    
+    def read_config(filename):
+        '''
+        Return the [main] options and a list of (name, options) for
+        each [mcu:<name>] section, as raw strings. Raises IOError, or
+        SettingsError if the file can not be parsed.
+        '''
+        # imported here, commands which never touch the settings
+        # should not pay for it
+        import ConfigParser
+        config = ConfigParser.RawConfigParser()
+        # make sure config file exists and is readable
+        with open(filename) as f:
+            try:
+                config.readfp(f)
+            except ConfigParser.Error, e:
+                raise SettingsError(str(e))
+        
+        try:
+            sections = []
+            for section in config.sections():
+                if section.startswith('mcu:'):
+                    sections.append((section[len('mcu:'):], dict(config.items(section))))
+            return dict(config.items('main')), sections
+        except ConfigParser.Error, e:
+            raise SettingsError(str(e))
+    
+    read_config = staticmethod(read_config)
+    
+    def replace(self, **changes):
+        '''
+        Return a copy of these settings with changes applied
+        '''
+        options = dict(self.options)
+        options.update(changes)
+        settings = object.__new__(type(self))
+        settings._load(self.filename, options, self.sections)
+        return settings
+    
+    def _load(self, filename, options, sections):
+        '''
+        Convert and validate options, applying defaults where
+        omitted.
+        '''
+        self.filename = filename
+        self.options = options
+        self.sections = sections
         
+        # replace defaults with values from config file
+        for name, default in self.defaults.iteritems():
+            value = options.get(name, default)
+            try:
+                setattr(self, name, self.types[name](value))
+            except ValueError:
+                raise SettingsError('invalid value for %s: %s' % (name, value))
+        
+        if self.loglevel not in LOG_LEVELS:
+            raise SettingsError('invalid loglevel: %s' % self.loglevel)
+        if self.log_queue_size < 1:
+            raise SettingsError('log_queue_size must be positive')
+        if self.log_repeat_interval < 0:
+            raise SettingsError('log_repeat_interval can not be negative')
+        if self.bus_backend not in ('smbus', 'sim'):
+            raise SettingsError('invalid bus_backend: %s' % self.bus_backend)
+        if not 0 <= self.sim_fault_rate <= 1:
+            raise SettingsError('sim_fault_rate must be between 0 and 1')
+        if self.stats_interval < 0:
+            raise SettingsError('stats_interval can not be negative')
+        if self.telemetry_capacity < 1:
+            raise SettingsError('telemetry_capacity must be positive')
+        if self.profile_every < 1:
+            raise SettingsError('profile_every must be positive')
+        if self.bus_lock_timeout <= 0:
+            raise SettingsError('bus_lock_timeout must be positive')
+        
+        # MCU targets, inheriting from [main]
+        targets = []
+        for name, target_cfg in sections:
+            target_options = {}
+            for option in self.target_options:
+                if option in target_cfg:
+                    try:
+                        value = self.types[option](target_cfg[option])
+                    except ValueError:
+                        raise SettingsError('[mcu:%s] invalid value for %s: %s' \
+                                            % (name, option, target_cfg[option]))
+                else:
+                    value = getattr(self, option)
+                target_options[option] = value
+            targets.append(TargetSettings(name, target_options))
+        if not targets:
+            target_options = {}
+            for option in self.target_options:
+                target_options[option] = getattr(self, option)
+            targets.append(TargetSettings('main', target_options))
+        # two sections for one MCU would correct each other every cycle
+        seen = {}
+        for target in targets:
+            key = (target.mcu_bus, target.mcu_address)
+            if key in seen:
+                raise SettingsError('[mcu:%s] and [mcu:%s] both supervise 0x%02x on bus %d' \
+                                    % (seen[key], target.name, key[1], key[0]))
+            seen[key] = target.name
+        self.targets = tuple(targets)
+        self._frozen = True
+    
+    def __setattr__(self, name, value):
+        if getattr(self, '_frozen', False):
+            raise AttributeError('settings are read-only')
+        object.__setattr__(self, name, value)
+    
+    def changed(self, other):
+        '''
+        Return names of options which differ from other settings
+        '''
+        names = [name for name in self.defaults
+                 if getattr(self, name) != getattr(other, name)]
+        names.sort()
+        return names
     
     def get_logger(self):
         '''
         Initialize and return logger instance.
-        Use settings from mcuctrl.conf.
+        Use settings from mcuctrl.conf. The logfile is not opened
+        before the first record is written to it, and records are
+        written by a background thread, see QueuedLogger.
         '''
+        import logging
+        import logging.handlers
         try:
             logger = logging.getLogger('mcuctrl')
             formatter = logging.Formatter(
                    '%(asctime)s %(levelname)s %(name)s - %(message)s',
                    '%Y-%m-%d %H:%M:%S')
-            handler = logging.handlers.RotatingFileHandler(
-                    filename=__mcu_settings__.logfile, mode='a',
-                    maxBytes=__mcu_settings__.logfile_max_size,
-                    backupCount=__mcu_settings__.logrotate_backup_count)
+            if __mcu_settings__.logfile:
+                handler = logging.handlers.RotatingFileHandler(
+                        filename=__mcu_settings__.logfile, mode='a',
+                        maxBytes=__mcu_settings__.logfile_max_size,
+                        backupCount=__mcu_settings__.logrotate_backup_count,
+                        delay=True)
+            else:
+                handler = logging.NullHandler()
             handler.setFormatter(formatter)
             logger.addHandler(handler)
-            levelmap = {'debug': logging.DEBUG, 'info': logging.INFO,
-                        'warning' : logging.WARNING, 'warn': logging.WARN,
-                        'error': logging.ERROR, 'critical': logging.CRITICAL}
-            logger.setLevel(levelmap.get(__mcu_settings__.loglevel, logging.ERROR))
+            logger.setLevel(logging.getLevelName(LOG_LEVELS[__mcu_settings__.loglevel]))
         except Exception, e:
             print e
             sys.exit(1)
 
-        return logger
+        return QueuedLogger(logger, __mcu_settings__.log_queue_size,
+                            __mcu_settings__.log_repeat_interval)
     
     get_logger = classmethod(get_logger)
+
+
+class TargetSettings(object):
+    '''
+    Settings for one supervised MCU. Has an attribute for each
+    of MCUSettings.target_options. Read-only.
+    '''
+    def __init__(self, name, options):
+        self.name = name
+        for key, val in options.iteritems():
+            setattr(self, key, val)
+        
+        if not 0 <= self.min_pwm_threshold < self.max_pwm_threshold <= 0xff:
+            raise SettingsError('[%s] PWM thresholds must satisfy 0 <= min < max <= 255' % name)
+        if not 0 <= self.default_brightness <= 0xff:
+            raise SettingsError('[%s] default_brightness must be between 0 and 255' % name)
+        if self.check_interval <= 0:
+            raise SettingsError('[%s] check_interval must be positive' % name)
+        if self.brightness_interval < 0 or self.firmware_interval < 0:
+            raise SettingsError('[%s] brightness_interval and firmware_interval '
+                                'can not be negative' % name)
+        if not 0 < self.fast_interval <= self.slow_interval:
+            raise SettingsError('[%s] intervals must satisfy 0 < fast_interval <= slow_interval' % name)
+        if self.register_cache_ttl < 0:
+            raise SettingsError('[%s] register_cache_ttl can not be negative' % name)
+        if self.polling_mode not in ('full', 'change'):
+            raise SettingsError('[%s] invalid polling_mode: %s' % (name, self.polling_mode))
+        if self.ramp_duration < 0 or self.ramp_max_rate <= 0 or self.brightness_step <= 0:
+            raise SettingsError('[%s] ramp_duration, ramp_max_rate and brightness_step '
+                                'must be positive' % name)
+        if self.control_mode not in ('static', 'auto'):
+            raise SettingsError('[%s] invalid control_mode: %s' % (name, self.control_mode))
+        if self.lux_filter not in ('ema', 'median'):
+            raise SettingsError('[%s] invalid lux_filter: %s' % (name, self.lux_filter))
+        if not 0 < self.lux_filter_alpha <= 1 or self.lux_filter_window < 1:
+            raise SettingsError('[%s] lux_filter_alpha must be in (0, 1], '
+                                'lux_filter_window at least 1' % name)
+        if self.lux_hysteresis < 0 or self.brightness_deadband < 0:
+            raise SettingsError('[%s] lux_hysteresis and brightness_deadband '
+                                'can not be negative' % name)
+        if self.bus_retries < 0 or self.bus_retry_delay < 0 or \
+                self.bus_retry_max_delay < self.bus_retry_delay:
+            raise SettingsError('[%s] bus_retries and bus_retry_delay can not be negative, '
+                                'bus_retry_max_delay not below bus_retry_delay' % name)
+        if self.breaker_threshold < 1 or self.breaker_timeout <= 0:
+            raise SettingsError('[%s] breaker_threshold and breaker_timeout '
+                                'must be positive' % name)
+        if self.snapshot_mode not in ('auto', 'combined', 'bytes'):
+            raise SettingsError('[%s] invalid snapshot_mode: %s' % (name, self.snapshot_mode))
+        try:
+            self.profile = get_profile(self.mcu_model)
+        except (IOError, ValueError), e:
+            raise SettingsError('[%s] invalid mcu_model: %s' % (name, e))
+        self.check_profile()
+        self._frozen = True
+    
+    def check_profile(self):
+        '''
+        Make sure the values the daemon writes are within the ranges
+        of the model profile, and that the registers the polling and
+        control modes read exist. Raises SettingsError.
+        '''
+        writes = self.profile.write_commands
+        values = [('default_brightness', 'brightness', self.default_brightness),
+                  ('min_pwm_threshold', 'pwm_min', self.min_pwm_threshold),
+                  ('max_pwm_threshold', 'pwm_max', self.max_pwm_threshold)]
+        reads = []
+        if self.control_mode == 'auto':
+            for lux, brightness in self.brightness_curve:
+                values.append(('brightness_curve', 'brightness', brightness))
+            reads.append('luxmode')
+        if self.polling_mode == 'change':
+            reads.append('change_status')
+        for option, register, value in values:
+            minimum, maximum = writes[register][1:]
+            if not minimum <= value <= maximum:
+                raise SettingsError('[%s] %s %d out of range %d-%d of %s in %s' \
+                                    % (self.name, option, value, minimum, maximum,
+                                       register, self.profile.name))
+        for register in reads:
+            if register not in self.profile.read_commands:
+                raise SettingsError('[%s] %s can not read %s' \
+                                    % (self.name, self.profile.name, register))
+    
+    def __setattr__(self, name, value):
+        if getattr(self, '_frozen', False):
+            raise AttributeError('settings are read-only')
+        object.__setattr__(self, name, value)
         
 
 class Daemon(object):
@@ -183,6 +1009,13 @@ class Daemon(object):
                  stdout=os.path.devnull, stderr=os.path.devnull):
         self.pidfile = pidfile
         self.pid = None
+        self.pidfd = None
+        self.ready_fd = None
+        self.stop_requested = False
+        # override profile_file and profile_every from mcuctrl.conf
+        self.profile_file = None
+        self.profile_every = None
+        self.profiler = None
         self.stdin = stdin
         self.stdout = stdout
         self.stderr = stderr
@@ -192,13 +1025,26 @@ class Daemon(object):
         do the UNIX double-fork magic, see Stevens' "Advanced
         Programming in the UNIX Environment" for details (ISBN 0201563177)
         http://www.erlenstar.demon.co.uk/unix/faq_2.html#SEC16
+        
+        The first parent waits until the daemon is ready, and exits
+        with status 1 if it fails to start.
         '''
+        ready_r, ready_w = os.pipe()
         # first fork
         try:
+            __mcu_logger__.close()
             pid = os.fork()
             if pid > 0:
-                # exit first parent
+                # wait for the daemon to report ready, see ready()
+                os.close(ready_w)
+                status = os.read(ready_r, 32)
+                if not status.startswith('R'):
+                    sys.stderr.write('daemon failed to start, see %s\n' \
+                                     % __mcu_settings__.logfile)
+                    sys.exit(1)
+                print '%s started, PID %s' % (sys.argv[0], status[1:].strip())
                 sys.exit(0)
+            os.close(ready_r)
         except OSError, e:
             message = 'first fork failed: %d (%s)\n' % (e.errno, e.args[1])
             sys.stderr.write(message)
@@ -212,6 +1058,7 @@ class Daemon(object):
         
         # second fork
         try:
+            __mcu_logger__.close()
             pid = os.fork()
             if pid > 0:
                 # exit second parent
@@ -235,33 +1082,134 @@ class Daemon(object):
             os.dup2(std_err.fileno(), sys.stderr.fileno())
     
         # write pidfile
-        atexit.register(self.del_pid)
         self.pid = os.getpid()
+        if not self.lock_pidfile():
+            message = 'pidfile %s is locked. Is daemon already running?' % self.pidfile
+            __mcu_logger__.critical(message)
+            sys.exit(1)
+        atexit.register(self.del_pid)
+        self.ready_fd = ready_w
         
         __mcu_logger__.debug('daemon PID is %d' % self.pid)
-        file(self.pidfile, 'w+').write('%d\n' % self.pid)
         __mcu_logger__.debug('wrote pidfile %s' % self.pidfile)
+    
+    def lock_pidfile(self):
+        '''
+        Create pidfile, lock it and write our PID to it. The lock is
+        held as long as the daemon runs, which tells a live daemon
+        from a stale pidfile. Returns False if another daemon holds
+        the lock.
+        '''
+        import fcntl
+        while True:
+            fd = os.open(self.pidfile, os.O_RDWR | os.O_CREAT, 0644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError, e:
+                os.close(fd)
+                if e.errno in (errno.EAGAIN, errno.EACCES):
+                    return False
+                raise
+            # start over if the file was removed as stale meanwhile
+            try:
+                if os.fstat(fd).st_ino == os.stat(self.pidfile).st_ino:
+                    break
+            except OSError:
+                pass
+            os.close(fd)
+        os.ftruncate(fd, 0)
+        os.write(fd, '%d\n' % self.pid)
+        self.pidfd = fd
+        return True
+    
+    def read_pid(self):
+        '''
+        Return PID of the running daemon, or None. A pidfile which
+        is not locked was left behind by a daemon that died, and is
+        removed. A daemon which has locked the pidfile is given a
+        second to write its PID; raises IOError with EAGAIN if it
+        does not.
+        '''
+        import fcntl
+        try:
+            fd = os.open(self.pidfile, os.O_RDONLY)
+        except OSError:
+            return None
+        try:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+            except IOError, e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+                deadline = time.time() + 1.0
+                while True:
+                    os.lseek(fd, 0, os.SEEK_SET)
+                    try:
+                        return int(os.read(fd, 32).strip())
+                    except ValueError:
+                        # daemon is just writing its PID
+                        if time.time() >= deadline:
+                            raise IOError(errno.EAGAIN, 'pidfile %s is locked, but holds '
+                                          'no PID' % self.pidfile)
+                        time.sleep(0.01)
+            __mcu_logger__.warning('removing stale pidfile %s' % self.pidfile)
+            try:
+                os.remove(self.pidfile)
+            except OSError:
+                pass
+            return None
+        finally:
+            os.close(fd)
         
     def del_pid(self):
         '''
         Delete pidfile
         '''
-        os.remove(self.pidfile)
-        __mcu_logger__.debug('removed pidfile %s' % self.pidfile)
+        if self.pidfd is not None and os.getpid() == self.pid:
+            os.remove(self.pidfile)
+            __mcu_logger__.debug('removed pidfile %s' % self.pidfile)
+    
+    def ready(self):
+        '''
+        Tell the waiting start command, and the service manager,
+        that the daemon is up
+        '''
+        if self.ready_fd is not None:
+            os.write(self.ready_fd, 'R%d\n' % self.pid)
+            os.close(self.ready_fd)
+            self.ready_fd = None
+        self.notify('READY=1\nMAINPID=%d' % os.getpid())
+    
+    def notify(self, state):
+        '''
+        Send state to the service manager through $NOTIFY_SOCKET,
+        like sd_notify(3). Does nothing when not run by one.
+        '''
+        path = os.environ.get('NOTIFY_SOCKET')
+        if not path:
+            return
+        if path.startswith('@'):
+            # abstract namespace socket
+            path = '\0' + path[1:]
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        try:
+            try:
+                sock.sendto(state, path)
+            except socket.error, e:
+                __mcu_logger__.warning('could not notify service manager: %s' % e)
+        finally:
+            sock.close()
         
     def start(self):
         '''
-        Start the daemon
+        Start the daemon. Returns when the daemon is ready.
         '''
-        # check for pidfile to determine if daemon is running
+        # a locked pidfile means the daemon is running
         try:
-            pidfile = file(self.pidfile, 'r')
-            pid = int(pidfile.read().strip())
-            pidfile.close()
+            running = self.read_pid() is not None
         except IOError:
-            pid = None
-        
-        if pid:
+            running = True
+        if running:
             message = 'pidfile %s already exists. Is daemon already running?\n'
             sys.stderr.write(message % self.pidfile)
             __mcu_logger__.warning(message % self.pidfile)
@@ -273,257 +1221,3612 @@ class Daemon(object):
         
     def stop(self):
         '''
-        Stop the daemon
+        Stop the daemon, and wait until it has exited. The daemon
+        finishes the bus transaction in progress first. It is killed
+        if it has not exited after STOP_TIMEOUT seconds.
         '''
-        # get pid from pidfile
+        import fcntl
         try:
-            pidfile = file(self.pidfile, 'r')
-            pid = int(pidfile.read().strip())
-            pidfile.close()
-        except IOError:
+            pid = self.read_pid()
+        except IOError, e:
+            print e
+            __mcu_logger__.critical(str(e))
+            sys.exit(1)
+        try:
+            fd = os.open(self.pidfile, os.O_RDONLY)
+        except OSError:
             pid = None
-        
+        if pid is not None and pid <= 1:
+            # never signal init, or every process with kill(-1)
+            message = 'pidfile %s holds invalid PID %d\n' % (self.pidfile, pid)
+            sys.stderr.write(message)
+            __mcu_logger__.critical(message)
+            os.close(fd)
+            sys.exit(1)
         if not pid:
             message = 'pidfile %s does not exist. Is daemon running?\n'
             sys.stderr.write(message % self.pidfile)
             __mcu_logger__.warning(message % self.pidfile)
             return      # not an error if restarting
         
-        # try killing the daemon process
+        # the pidfile lock is released the moment the daemon exits
+        waiter = threading.Thread(target=fcntl.flock, args=(fd, fcntl.LOCK_EX))
+        waiter.setDaemon(True)
         try:
-            while True:
+            try:
                 os.kill(pid, SIGTERM)
-                time.sleep(0.1)
-            self.pid = None
-        except OSError, e:
-            err = str(e)
-            if err.find("No such process") > 0:
-                if os.path.exists(self.pidfile):
-                    self.del_pid()
-            else:
-                # print error message and exit
-                print err
-                __mcu_logger__.critical(err)
-                sys.exit(1)
+                waiter.start()
+                waiter.join(STOP_TIMEOUT)
+                if waiter.isAlive():
+                    __mcu_logger__.error('daemon did not stop in %d seconds, killing it' \
+                                         % STOP_TIMEOUT)
+                    os.kill(pid, SIGKILL)
+                    waiter.join(STOP_TIMEOUT)
+            except OSError, e:
+                if e.errno != errno.ESRCH:
+                    # print error message and exit
+                    print e
+                    __mcu_logger__.critical(str(e))
+                    sys.exit(1)
+        finally:
+            os.close(fd)
+        # removed by the daemon, unless it was killed
+        try:
+            if self.read_pid() is None and os.path.exists(self.pidfile):
+                os.remove(self.pidfile)
+        except IOError:
+            # another daemon is starting
+            pass
+        self.pid = None
         print '%s stopped' % sys.argv[0]
         __mcu_logger__.info('daemon stopped')
         
     def restart(self):
         '''
-        Restart the daemon
+        Restart the daemon. stop returns as soon as the old daemon
+        has exited, and start as soon as the new one is ready, so
+        the MCUs are unsupervised for well under a check interval.
         '''
         __mcu_logger__.info('restarting daemon')
         self.stop()
         self.start()
+    
+    def request_stop(self, signum=None, frame=None):
+        '''
+        SIGTERM handler. The main loop stops the daemon.
+        '''
+        self.stop_requested = True
+    
+    def shutdown(self):
+        '''
+        Stop all bus workers, waiting for polls in progress, so no
+        bus transaction is cut off by the exit
+        '''
+        self.notify('STOPPING=1')
+        __mcu_logger__.info('daemon stopping')
+        for worker in self.workers.values():
+            worker.stop()
+        for worker in self.workers.values():
+            # held until exit, so workers can not start another poll
+            worker.lock.acquire(arbitrate=False)
+            # a worker still waiting at exit may trip over the
+            # interpreter shutting down
+            if worker.isAlive():
+                worker.join(1.0)
+        if self.state is not None:
+            self.state.invalidate()
+        if self.control:
+            self.control.close()
         
     def run(self):
         '''
         Daemon runtime code.
+        
+        Every MCU target is polled by the worker of its bus. Targets on
+        the same bus are polled one at a time, while each bus gets a
+        thread of its own, so a hung adapter does not hold up the
+        others. The main thread serves the control socket, and reloads
+        the settings on SIGHUP or when mcuctrl.conf changes.
         '''
         print '%s started' % sys.argv[0]
         __mcu_logger__.info('daemon running')
-        mcu = MCUControl(__mcu_settings__.mcu_bus,
-                         __mcu_settings__.mcu_address)
-        while True:
-            __mcu_logger__.debug('daemon performing checks..')
-            # compare actual values to config file values
-            cur_pwm_min = mcu.read_byte('pwm_min')
-            cur_pwm_max = mcu.read_byte('pwm_max')
-            cur_brightness = mcu.read_byte('brightness')
-            cfg_pwm_min = __mcu_settings__.min_pwm_threshold
-            cfg_pwm_max = __mcu_settings__.max_pwm_threshold
-            cfg_brightness = __mcu_settings__.default_brightness
-            
+        profile_file = self.profile_file or __mcu_settings__.profile_file
+        if profile_file:
+            self.profiler = Profiler(profile_file,
+                    self.profile_every or __mcu_settings__.profile_every)
+            __mcu_logger__.profiler = self.profiler
+            __mcu_logger__.info('profiling every %d. poll cycle to %s' \
+                                % (self.profiler.every, profile_file))
+        self.telemetry = TelemetryRing(__mcu_settings__.telemetry_capacity,
+                                       __mcu_settings__.telemetry_file or None)
+        atexit.register(self.telemetry.close)
+        self.trace = None
+        if __mcu_settings__.trace_file:
             try:
-                flag = False
-                if not cur_pwm_min == int(cfg_pwm_min):
-                    flag = True
-                    __mcu_logger__.warning('[%d] PWM MIN Read %d (0x%02x). Applying corrective meassures' \
-                                        % (self.pid, cur_pwm_min, int(cfg_pwm_min)))
-                    mcu.write_byte('pwm_min', int(cfg_pwm_min))
-                if not cur_pwm_max == int(cfg_pwm_max):
-                    flag = True
-                    __mcu_logger__.warning('[%d] PWM MAX Read %d (0x%02x). Applying corrective meassures' \
-                                        % (self.pid, cur_pwm_max, int(cfg_pwm_max)))
-                    mcu.write_byte('pwm_max', int(cfg_pwm_max))
-                # If flag is set, set brightness to default value
-                if flag:
-                    __mcu_logger__.warning('[%d] BRIGHTNESS Read %d (0x%02x). Applying corrective meassures' \
-                                        % (self.pid, cur_brightness, int(cfg_brightness)))
-                    mcu.write_byte('brightness', int(cfg_brightness))
-                else:
-                    __mcu_logger__.debug('daemon - all values within threshold,')
-            except Exception, e:
-                print e
-                __mcu_logger__.critical(e.args[1])
-                sys.exit(1)
-            
-            __mcu_logger__.debug('daemon done performing checks')
-            time.sleep(int(__mcu_settings__.check_interval))
-
-
-class MCUControl(object):
-    '''
-    This class handles reading and writing to the
-    MCU through the python smbus interface.
-    '''
-    def __init__(self, busno=0,
-                 address=0x34):
-        self.busno = busno
-        self.address = address
+                self.trace = TraceFile(__mcu_settings__.trace_file)
+                atexit.register(self.trace.close)
+            except (IOError, OSError), e:
+                __mcu_logger__.error('not tracing bus transactions: %s' % e)
+        self.state = None
+        if __mcu_settings__.state_file:
+            try:
+                self.state = StateFile(__mcu_settings__.state_file)
+                atexit.register(self.state.close)
+            except EnvironmentError, e:
+                __mcu_logger__.error('not publishing register values: %s' % e)
+        self.workers = {}
+        self.targets = []
+        for target_settings in __mcu_settings__.targets:
+            self.add_target(target_settings)
         
-        try:
-            self.bus = SMBus(int(busno))
-        except IOError, e:
-            message = 'Could not open smbus /dev/i2c-%d. %s' % (int(busno), e.args[1])
-            print message
-            __mcu_logger__.critical(message)
-            sys.exit(1)
-            
-    def read_byte(self, cmd):
-        cmd_read_map = {
-           'brightness' : BRIGHTNESS_R,
-           'volume' : VOLUME_R,
-           'fw' : FW_VERSION_R,
-           'fwtype' : FW_TYPE_R,
-           'flag' : FLAG_R,
-           'backlight' : BACKLIGHT_R,
-           'rdname' : RD_NAME_R,
-           'function' : FUNCTION_R,
-           'luxmode' : LUX_MODE_R,
-           'change_status' : CHANGE_STATUS_R,
-           'pwm_max' : BRIGHTNESS_PWM_MAX_RW,
-           'pwm_min' : BRIGHTNESS_PWM_MIN_RW
-           }
-        
-        try:
-            cmd_value = cmd_read_map[cmd]
-            retval = self.bus.read_byte_data(int(self.address, 16), cmd_value)
-        except KeyError, e:
-            print 'Command not found: %s' % cmd
-            sys.exit(1)
-        except Exception, e:
-            print e
-            __mcu_logger__.error(e.args[1])
-            sys.exit(1)
-
-        return retval
-    
-    def write_byte(self, cmd, value):
-        cmd_write_map = {
-           'inc_brightness' : INCREASE_BRIGHTNESS_W,
-           'dec_brightness' : DECREASE_BRIGHTNESS_W,
-           'inc_volume' : INCREASE_VOLUME_W,
-           'dec_volume' : DECREASE_VOLUME_W,
-           'mute' : MUTE_W,
-           'volume' : VOLUME_W,
-           'brightness' : BRIGHTNESS_W,
-           'inverter' : INVERTER_W,
-           'polling' : POLLING_W,
-           'backlight' : BACKLIGHT_W,
-           'auto_dimming' : AUTO_DIMMING_W,
-           'luxmode' : LUX_MODE_W,
-           'keypad_lock' : KEYPAD_LOCK_W,
-           'pwm_max' : BRIGHTNESS_PWM_MAX_RW,
-           'pwm_min' : BRIGHTNESS_PWM_MIN_RW
-           }
-        
-        try:
-            # read and validate pwm_min, pwm_max and brightness from config 
-            # before saving new values.
-            cfg_pwm_min = __mcu_settings__.min_pwm_threshold
-            cfg_pwm_max = __mcu_settings__.max_pwm_threshold
+        self.control = None
+        if __mcu_settings__.control_socket:
+            self.control = ControlServer(__mcu_settings__.control_socket, self.targets)
+            atexit.register(self.control.close)
+        
+        self.reload_requested = False
+        self.stats_requested = False
+        self.config_mtime = self.get_config_mtime()
+        signal.signal(SIGUSR1, self.request_stats)
+        signal.signal(SIGHUP, self.request_reload)
+        signal.signal(SIGTERM, self.request_stop)
+        
+        # open the buses up front, so ready means supervising
+        for target in self.targets:
+            try:
+                target.open()
+            except BusError, e:
+                __mcu_logger__.error('[%s] %s' % (target.name, e.strerror))
+        for worker in self.workers.values():
+            worker.start()
+        self.ready()
+        next_stats = time.time() + __mcu_settings__.stats_interval
+        while not self.stop_requested:
+            # wake up regularly to look for changes to mcuctrl.conf
+            timeout = CONFIG_POLL_INTERVAL
+            if __mcu_settings__.stats_interval:
+                timeout = max(0, min(timeout, next_stats - time.time()))
+            if self.reload_requested or self.stats_requested:
+                # signalled while the last requests were handled
+                timeout = 0
+            if self.control:
+                self.control.serve(timeout)
+            else:
+                time.sleep(timeout)
             
-            # save new settings
-            cmd_value = cmd_write_map[cmd]
-            self.bus.write_byte_data(int(self.address, 16),
-                                     cmd_value, int(value))
-            __mcu_logger__.info('Wrote %s value %d (0x%02x)' % (cmd, int(value), int(value)))
+            if self.stop_requested:
+                break
+            mtime = self.get_config_mtime()
+            if self.reload_requested or mtime != self.config_mtime:
+                self.reload_requested = False
+                self.config_mtime = mtime
+                self.notify('RELOADING=1')
+                if self.profiler is not None:
+                    self.profiler.call(self.reload)
+                else:
+                    self.reload()
+                self.notify('READY=1')
             
-            # make sure min and max pwm thresholds always are in range
-            if self.read_byte('pwm_min') < int(cfg_pwm_min):
-                self.bus.write_byte_data(int(self.address, 16),
-                                     cmd_write_map['pwm_min'], int(cfg_pwm_min))
-                __mcu_logger__.warning('PWM MIN out of defined range: Wrote new value %d (0x%02x)' \
-                                    % (int(cfg_pwm_min), int(cfg_pwm_min)))
-            if self.read_byte('pwm_max') > int(cfg_pwm_max):
-                self.bus.write_byte_data(int(self.address, 16),
-                                     cmd_write_map['pwm_max'], int(cfg_pwm_max))
-                __mcu_logger__.warning('PWM MAX out of defined range: Wrote new value %d (0x%02x)' \
-                                    % (int(cfg_pwm_max), int(cfg_pwm_max)))
-        
-        except KeyError, e:
-            print 'Command not found: %s' % cmd
-            sys.exit(1)
-        except Exception, e:
-            print e
-            __mcu_logger__.error(e.args[1])
-            sys.exit(1)
-
-        return True
+            if self.stats_requested or \
+                    (__mcu_settings__.stats_interval and time.time() >= next_stats):
+                self.stats_requested = False
+                self.dump_stats()
+                next_stats = time.time() + __mcu_settings__.stats_interval
+        self.shutdown()
+        if self.profiler is not None:
+            self.dump_stats()
     
-
-# Global objects
-__mcu_settings__ = MCUSettings()
-__mcu_logger__ = MCUSettings.get_logger()
-
-if __name__ == '__main__':
-    # create the daemon instance
-    daemon = Daemon(__mcu_settings__.pidfile)
+    def add_target(self, target_settings):
+        '''
+        Start supervising a MCU, on the worker of its bus
+        '''
+        busno = target_settings.mcu_bus
+        if busno not in self.workers:
+            self.workers[busno] = BusWorker(busno, self.profiler)
+            if hasattr(self, 'control'):
+                # daemon is already running
+                self.workers[busno].start()
+        worker = self.workers[busno]
+        target = MCUTarget(target_settings, worker.lock, self.pid, self.telemetry,
+                           self.trace, self.state)
+        worker.set_targets(worker.targets + [target])
+        self.targets.append(target)
     
-    #
-    # optpars callback functions
-    #
-    def read_mcu_callback(option, opt_str, value, parser):
+    def remove_target(self, target):
         '''
-        Validate arguments, and process read command
+        Stop supervising a MCU
         '''
-        if not parser.values.bus:
-            raise OptionValueError('must set bus number before read option')
-        if not parser.values.addr:
-            raise OptionValueError('must set address before read option')
-            
-        # make sure bus and address are numeric values
-        try:
-            mcu_bus = '%d' % int(parser.values.bus)
-            mcu_addr = '%x' % int(parser.values.addr)
-            mcu = MCUControl(busno=mcu_bus, address=mcu_addr)
-            retval = mcu.read_byte(value)
-            print 'Read %s: %d (0x%02x)' % (value, retval, retval)
-        except Exception, e:
-            print e
-            __mcu_logger__.debug(e.args[1])
-            sys.exit(1)
-        
-        
-    def write_mcu_callback(option, opt_str, value, parser):
+        worker = self.workers[target.busno]
+        worker.set_targets([t for t in worker.targets if t is not target])
+        self.targets.remove(target)
+    
+    def request_reload(self, signum=None, frame=None):
         '''
-        Validate arguments, and process write command
+        SIGHUP handler. The reload itself is done by the main loop.
         '''
-        if not parser.values.bus:
-            raise OptionValueError('must set bus number before write option')
-        if not parser.values.addr:
-            raise OptionValueError('must set address before write option')
-            
-        # make sure bus and address are numeric values
-        try:
-            mcu_bus = '%d' % int(parser.values.bus)
-            mcu_addr = '%x' % int(parser.values.addr)
-            mcu = MCUControl(busno=mcu_bus, address=mcu_addr)
-            mcu.write_byte(value[0], value[1])
-            print 'Wrote %s: %d (0x%02x)' % (value[0], int(value[1]), int(value[1]))
-        except Exception, e:
-            print e
-            __mcu_logger__.debug(e.args[1])
-            sys.exit(1)
+        self.reload_requested = True
     
-    def daemon_callback(option, opt_str, value, parser):
+    def request_stats(self, signum=None, frame=None):
         '''
-        This callback method controls the start, stop and restart
-        commands from optparse to the daemon.
+        SIGUSR1 handler. The statistics are written by the main loop,
+        which may hold the BusStats lock when the signal arrives.
         '''
+        self.stats_requested = True
+    
+    def get_config_mtime(self):
         try:
-            if value == 'start':
+            return os.stat(__mcu_settings__.filename).st_mtime
+        except OSError:
+            return None
+    
+    def reload(self):
+        '''
+        Read mcuctrl.conf again and swap in the new settings, keeping
+        open bus handles and register caches. Invalid settings are
+        rejected, and the current settings stay in effect.
+        '''
+        old = __mcu_settings__._get()
+        try:
+            new = MCUSettings.load(old.filename)
+        except (IOError, SettingsError), e:
+            __mcu_logger__.error('not reloading settings: %s' % e)
+            return
+        
+        __mcu_settings__._set(new)
+        changed = new.changed(old)
+        __mcu_logger__.info('reloaded settings, changed: %s' % (', '.join(changed) or 'none'))
+        
+        if 'loglevel' in changed:
+            import logging
+            __mcu_logger__.setLevel(logging.getLevelName(LOG_LEVELS[new.loglevel]))
+        if 'log_repeat_interval' in changed:
+            __mcu_logger__.repeat_interval = new.log_repeat_interval
+        for name in ('pidfile', 'logfile', 'logrotate_backup_count',
+                     'logfile_max_size', 'log_queue_size', 'bus_backend',
+                     'control_socket', 'profile_file', 'profile_every',
+                     'trace_file', 'state_file', 'bus_lock_dir'):
+            if name in changed:
+                __mcu_logger__.warning('%s changed, restart daemon to apply' % name)
+        
+        # update targets in place where bus and address are unchanged
+        current = {}
+        for target in self.targets:
+            current[target.name] = target
+        for target_settings in new.targets:
+            target = current.pop(target_settings.name, None)
+            if target is not None and target.busno == target_settings.mcu_bus \
+                    and target.address == target_settings.mcu_address:
+                target.update(target_settings)
+                # a target checked right away must not wait for the
+                # worker's old deadline
+                self.workers[target.busno].wake()
+                continue
+            if target is not None:
+                self.remove_target(target)
+            self.add_target(target_settings)
+        for target in current.values():
+            self.remove_target(target)
+        if self.control:
+            self.control.targets = list(self.targets)
+    
+    def dump_stats(self):
+        '''
+        Write bus statistics to stats_file, or to the log if no
+        stats_file is set. Done on SIGUSR1 and every stats_interval.
+        
+        When profiling, the profile is written to its file, and its
+        summary added to the statistics.
+        '''
+        report = __mcu_stats__.report()
+        lines = ['%-12s %-10s %10s %8s %8s %10s' \
+                 % ('target', 'check', 'interval', 'runs', 'missed', 'late ms')]
+        for target in self.targets:
+            for check, interval, runs, missed, late in target.schedule.report():
+                lines.append('%-12s %-10s %10.1f %8d %8d %10.3f' \
+                             % (target.name, check, interval, runs, missed, late * 1000))
+        report += '\n'.join(lines) + '\n'
+        if self.profiler is not None:
+            report += self.profiler.summary()
+            try:
+                self.profiler.dump()
+            except (IOError, OSError), e:
+                __mcu_logger__.error('could not write profile: %s' % e)
+        if not __mcu_settings__.stats_file:
+            for line in report.splitlines():
+                __mcu_logger__.info(line)
+            return
+        try:
+            # write and rename, so readers never see a partial report
+            filename = __mcu_settings__.stats_file
+            f = open(filename + '.tmp', 'w')
+            try:
+                f.write(report)
+            finally:
+                f.close()
+            os.rename(filename + '.tmp', filename)
+        except (IOError, OSError), e:
+            __mcu_logger__.error('could not write stats: %s' % e)
+
+
+class BusWorker(threading.Thread):
+    '''
+    Thread polling all MCU targets on one bus. The lock serializes
+    all access to the bus, see BusLock; polls wait for it behind
+    interactive users. A poll which can not get the bus within
+    bus_lock_timeout is retried after fast_interval, a poll failing
+    with any other error after slow_interval. Polls are sampled by
+    profiler, if given.
+    '''
+    def __init__(self, busno, profiler=None):
+        threading.Thread.__init__(self, name='bus-%d' % busno)
+        self.setDaemon(True)
+        self.busno = busno
+        self.lock = get_bus_lock(busno)
+        self.targets = []
+        self.profiler = profiler
+        self.stopping = threading.Event()
+        self.waking = threading.Event()
+    
+    def stop(self):
+        '''
+        Stop polling once the poll in progress is done
+        '''
+        self.stopping.set()
+        self.waking.set()
+    
+    def wake(self):
+        '''
+        Look at the next_run of the targets again, after it was
+        moved forward
+        '''
+        self.waking.set()
+    
+    def set_targets(self, targets):
+        '''
+        Replace the list of targets. The list is swapped as a whole,
+        so the running worker never sees it half updated.
+        '''
+        self.targets = targets
+        self.wake()
+    
+    def run(self):
+        __mcu_logger__.debug('supervising /dev/i2c-%d' % self.busno)
+        while not self.stopping.isSet():
+            targets = self.targets
+            for target in targets:
+                if self.stopping.isSet():
+                    return
+                if target.next_run <= monotonic():
+                    try:
+                        self.lock.acquire(priority=PRIORITY_BACKGROUND)
+                    except BusError, e:
+                        __mcu_logger__.warning('[%s] check postponed: %s' \
+                                               % (target.name, e.strerror))
+                        target.next_run = monotonic() + target.settings.fast_interval
+                        continue
+                    __mcu_stats__.begin_cycle()
+                    try:
+                        if self.profiler is not None:
+                            target.next_run = self.profiler.run(target.poll)
+                        else:
+                            target.next_run = target.poll()
+                    except Exception, e:
+                        # keep supervising the other targets; this one
+                        # is tried again once slow_interval has passed
+                        import traceback
+                        __mcu_logger__.error('[%s] poll failed: %s: %s, retrying in %.1f seconds' \
+                                             % (target.name, e.__class__.__name__, e,
+                                                target.settings.slow_interval))
+                        __mcu_logger__.debug(traceback.format_exc())
+                        target.next_run = monotonic() + target.settings.slow_interval
+                    finally:
+                        __mcu_stats__.end_cycle()
+                        self.lock.release()
+            
+            if not targets:
+                # all targets on this bus removed by a reload
+                self.waking.wait(CONFIG_POLL_INTERVAL)
+                self.waking.clear()
+                continue
+            wait = min([t.next_run for t in targets]) - monotonic()
+            if wait > 0:
+                self.waking.wait(wait)
+            self.waking.clear()
+
+
+def monotonic():
+    '''
+    Return seconds of a clock which is not set back or forward
+    with the wall clock. Falls back to time.time() where
+    clock_gettime(CLOCK_MONOTONIC) is not available.
+    '''
+    if not MONOTONIC_CLOCK:
+        # ctypes is only imported by the daemon
+        clock = time.time
+        try:
+            import ctypes
+            import ctypes.util
+            
+            class timespec(ctypes.Structure):
+                _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+            
+            librt = ctypes.CDLL(ctypes.util.find_library('rt') or 'librt.so.1')
+            clock_gettime = librt.clock_gettime
+            clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+            
+            def clock():
+                now = timespec()
+                if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(now)) != 0:
+                    return time.time()
+                return now.tv_sec + now.tv_nsec * 1e-9
+            clock()
+        except (ImportError, OSError, AttributeError):
+            clock = time.time
+        MONOTONIC_CLOCK.append(clock)
+    return MONOTONIC_CLOCK[0]()
+
+
+class Scheduler(object):
+    '''
+    Runs named tasks, each at a rate of its own, against absolute
+    deadlines on the monotonic clock. The next deadline of a task
+    is its previous deadline plus its interval, so neither the time
+    the task takes nor waking up late adds up as drift.
+    
+    A task which runs after its next deadline has already passed
+    has missed the deadlines in between. They are counted, and
+    skipped rather than run in a burst.
+    '''
+    def __init__(self):
+        # name to [interval, deadline, runs, missed, most late]
+        self.tasks = {}
+    
+    def add(self, name, interval, now=None):
+        '''
+        Schedule task every interval seconds, starting now. A task
+        already scheduled keeps its deadline, unless the new
+        interval brings it closer. interval 0 removes the task.
+        '''
+        if now is None:
+            now = monotonic()
+        if interval <= 0:
+            self.tasks.pop(name, None)
+        elif name in self.tasks:
+            task = self.tasks[name]
+            task[0] = interval
+            task[1] = min(task[1], now + interval)
+        else:
+            self.tasks[name] = [interval, now, 0, 0, 0.0]
+    
+    def trigger(self, name, now=None):
+        '''
+        Make task due now
+        '''
+        if name in self.tasks:
+            if now is None:
+                now = monotonic()
+            self.tasks[name][1] = min(self.tasks[name][1], now)
+    
+    def due(self, now):
+        '''
+        Return names of tasks due at now, the earliest first
+        '''
+        due = [(task[1], name) for name, task in self.tasks.iteritems()
+               if task[1] <= now]
+        due.sort()
+        return [name for deadline, name in due]
+    
+    def done(self, name, now, interval=None):
+        '''
+        Mark task run at now, optionally changing its interval, and
+        schedule its next deadline. Returns number of deadlines
+        missed.
+        '''
+        task = self.tasks[name]
+        if interval is not None:
+            task[0] = interval
+        task[2] += 1
+        task[4] = max(task[4], now - task[1])
+        deadline = task[1] + task[0]
+        missed = 0
+        if deadline <= now:
+            missed = int((now - deadline) / task[0]) + 1
+            deadline += missed * task[0]
+            task[3] += missed
+        task[1] = deadline
+        return missed
+    
+    def postpone(self, until):
+        '''
+        Move deadlines before until to until, without counting them
+        as missed. Used to back off after bus errors.
+        '''
+        for task in self.tasks.values():
+            task[1] = max(task[1], until)
+    
+    def next_deadline(self):
+        return min([task[1] for task in self.tasks.values()])
+    
+    def report(self):
+        '''
+        Return list of (name, interval, runs, missed, most late)
+        '''
+        names = self.tasks.keys()
+        names.sort()
+        return [(name, self.tasks[name][0]) + tuple(self.tasks[name][2:])
+                for name in names]
+
+
+class MCUTarget(object):
+    '''
+    Polling state of one supervised MCU. Every sample taken, and
+    every corrective write, is recorded in the telemetry ring
+    buffer, if given, and every bus transaction in trace, a
+    TraceFile. Register values are published in state, a
+    StateFile, if given. backend overrides bus_backend from
+    mcuctrl.conf. lock is the BusLock of the bus.
+    
+    Checks run on a Scheduler, each at its own rate: the PWM
+    thresholds every check_interval, brightness samples every
+    brightness_interval and the firmware every firmware_interval.
+    In change polling mode the change status register is read
+    every tick in between.
+    '''
+    def __init__(self, settings, lock, pid, telemetry=None, trace=None, state=None):
+        self.settings = settings
+        self.telemetry = telemetry
+        self.trace = trace
+        self.state = state
+        self.backend = None
+        self.name = settings.name
+        self.busno = settings.mcu_bus
+        self.address = settings.mcu_address
+        self.lock = lock
+        self.pid = pid
+        self.mcu = None
+        self.auto = None
+        self.interval = settings.slow_interval
+        self.firmware = None
+        self.schedule = Scheduler()
+        self.schedule_checks()
+        # monotonic time of the next poll
+        self.next_run = 0
+    
+    def schedule_checks(self):
+        '''
+        Schedule the checks for the current settings
+        '''
+        settings = self.settings
+        if settings.polling_mode == 'change':
+            self.schedule.add('change', self.interval)
+        else:
+            self.schedule.add('change', 0)
+        self.schedule.add('pwm', settings.check_interval)
+        self.schedule.add('brightness', settings.brightness_interval)
+        # read once at start, even if not read again later
+        self.schedule.add('firmware', settings.firmware_interval or 1e9)
+    
+    def open(self):
+        '''
+        Open the bus, if not already open, and return MCUControl
+        '''
+        if self.mcu is None:
+            state = None
+            if self.state is not None:
+                state = self.state.slot(self.busno, self.address)
+                if state is None:
+                    __mcu_logger__.warning('[%s] no free slot in %s, not publishing '
+                                           'register values' % (self.name, self.state.filename))
+            self.mcu = MCUControl(self.busno, '%x' % self.address,
+                    cache_ttl=self.settings.register_cache_ttl,
+                    min_pwm_threshold=self.settings.min_pwm_threshold,
+                    max_pwm_threshold=self.settings.max_pwm_threshold,
+                    backend=self.backend, lock=self.lock,
+                    profile=self.settings.profile, trace=self.trace,
+                    state=state)
+            self.configure(self.mcu)
+        return self.mcu
+    
+    def configure(self, mcu):
+        '''
+        Apply target settings to MCUControl
+        '''
+        mcu.cache_ttl = self.settings.register_cache_ttl or None
+        mcu.min_pwm_threshold = self.settings.min_pwm_threshold
+        mcu.max_pwm_threshold = self.settings.max_pwm_threshold
+        mcu.retries = self.settings.bus_retries
+        mcu.retry_delay = self.settings.bus_retry_delay
+        mcu.retry_max_delay = self.settings.bus_retry_max_delay
+        mcu.breaker.threshold = self.settings.breaker_threshold
+        mcu.breaker.timeout = self.settings.breaker_timeout
+        if mcu.snapshot_mode != self.settings.snapshot_mode:
+            mcu.snapshot_mode = self.settings.snapshot_mode
+            mcu.combined = None
+        if mcu.profile is not self.settings.profile:
+            # command bytes of another model mean nothing here
+            mcu.profile = self.settings.profile
+            mcu.invalidate()
+    
+    def update(self, settings):
+        '''
+        Apply reloaded settings, keeping the bus handle and the
+        register cache. Changed targets are checked right away.
+        '''
+        # no bus access, so other processes need not be waited for
+        self.lock.acquire(arbitrate=False)
+        try:
+            check = settings.min_pwm_threshold != self.settings.min_pwm_threshold or \
+                    settings.max_pwm_threshold != self.settings.max_pwm_threshold or \
+                    settings.default_brightness != self.settings.default_brightness
+            self.settings = settings
+            # auto brightness controller is rebuilt from new settings
+            self.auto = None
+            self.interval = min(self.interval, settings.slow_interval)
+            self.schedule_checks()
+            if check:
+                self.schedule.trigger('pwm')
+                self.next_run = 0
+            if self.mcu is not None:
+                self.configure(self.mcu)
+        finally:
+            self.lock.release()
+    
+    def poll(self, now=None):
+        '''
+        Run the checks which are due at now, by default the
+        monotonic time, and return the monotonic time of the next
+        poll. A poll failing with a bus error is retried after
+        fast_interval, or when the circuit breaker lets transactions
+        through again.
+        '''
+        if now is None:
+            now = monotonic()
+        due = self.schedule.due(now)
+        try:
+            mcu = self.open()
+            changed = 0
+            if 'change' in due:
+                # one cheap read per tick, full compare only on change
+                changed = mcu.read_byte('change_status')
+                self.record(CHANGE_STATUS_R, changed)
+                if changed:
+                    __mcu_logger__.debug('[%s] change status 0x%02x' % (self.name, changed))
+                    mcu.invalidate()
+            corrected = False
+            if changed or 'pwm' in due:
+                # the cache is only trusted while the change status
+                # register tells when the MCU was changed behind it
+                corrected = self.check(mcu, cached=self.settings.polling_mode == 'change')
+                if 'pwm' in due:
+                    self.done('pwm', now)
+            if 'change' in due:
+                self.interval = self.next_interval(changed or corrected)
+                self.done('change', now, self.interval)
+            if 'brightness' in due:
+                self.record(BRIGHTNESS_R, mcu.read_byte('brightness'))
+                self.done('brightness', now)
+            if 'firmware' in due:
+                self.check_firmware(mcu)
+                self.done('firmware', now)
+            
+            # auto brightness follows the polling tick
+            tick = self.settings.polling_mode == 'change' and 'change' or 'pwm'
+            if tick in due and self.settings.control_mode == 'auto':
+                self.adjust_brightness(mcu)
+        except BusError, e:
+            retry = self.settings.fast_interval
+            if self.mcu is not None:
+                retry = max(retry, self.mcu.breaker.retry_in())
+            __mcu_logger__.error('[%s] poll failed: %s, retrying in %.1f seconds' \
+                                 % (self.name, e.strerror, retry))
+            self.schedule.postpone(now + retry)
+        return self.schedule.next_deadline()
+    
+    def done(self, check, now, interval=None):
+        '''
+        Schedule the next run of check, logging missed deadlines
+        '''
+        missed = self.schedule.done(check, now, interval)
+        if missed:
+            __mcu_logger__.warning('[%s] %s check missed %d deadlines' \
+                                   % (self.name, check, missed))
+    
+    def check_firmware(self, mcu):
+        '''
+        Read firmware version and type, bypassing the register
+        cache, and warn if they changed since the last read.
+        '''
+        firmware = mcu.snapshot(('fw', 'fwtype'), cached=False)
+        firmware = (firmware.fw, firmware.fwtype)
+        if self.firmware is not None and firmware != self.firmware:
+            __mcu_logger__.warning('[%s] firmware changed from %d type %d to %d type %d' \
+                                   % ((self.name,) + self.firmware + firmware))
+            mcu.invalidate()
+        self.firmware = firmware
+        self.record(FW_VERSION_R, firmware[0])
+    
+    def record(self, register, value, flags=0):
+        '''
+        Record a sample in the telemetry ring buffer
+        '''
+        if self.telemetry is not None:
+            self.telemetry.append(time.time(), self.busno, self.address,
+                                  register, value, flags)
+    
+    def adjust_brightness(self, mcu):
+        '''
+        Sample the ambient light and write the brightness the auto
+        brightness controller asks for, if any.
+        '''
+        if self.auto is None:
+            self.auto = AutoBrightness(self.settings)
+        sample = mcu.read_byte('luxmode', cached=False)
+        self.record(LUX_MODE_R, sample)
+        brightness = self.auto.update(sample)
+        if brightness is None:
+            return
+        self.record(BRIGHTNESS_W, brightness, TELEMETRY_WRITE)
+        __mcu_logger__.debug('[%s] ambient light %d, brightness %d' \
+                             % (self.name, sample, brightness))
+        if self.settings.ramp_duration:
+            mcu.ramp_brightness(brightness, self.settings.ramp_duration,
+                                self.settings.ramp_max_rate,
+                                self.settings.brightness_step, wait=False)
+        else:
+            mcu.write_byte('brightness', brightness, verify=False)
+    
+    def next_interval(self, active):
+        '''
+        Adapt the polling tick: drop to the fast bound on activity,
+        back off towards the slow bound while idle.
+        '''
+        if active:
+            return self.settings.fast_interval
+        return min(self.interval * 2, self.settings.slow_interval)
+    
+    def check(self, mcu, cached=False):
+        '''
+        Compare actual values to config file values, and apply
+        corrective meassures. Returns True if anything was written.
+        The PWM thresholds are read from the bus unless cached is
+        True.
+        '''
+        __mcu_logger__.debug('[%s] daemon performing checks..' % self.name)
+        current = mcu.snapshot(('pwm_min', 'pwm_max'), cached=cached)
+        cur_pwm_min = current.pwm_min
+        cur_pwm_max = current.pwm_max
+        cfg_pwm_min = self.settings.min_pwm_threshold
+        cfg_pwm_max = self.settings.max_pwm_threshold
+        cfg_brightness = self.settings.default_brightness
+        corrective = TELEMETRY_CORRECTIVE | TELEMETRY_WRITE
+        self.record(BRIGHTNESS_PWM_MIN_RW, cur_pwm_min,
+                    cur_pwm_min != cfg_pwm_min and TELEMETRY_CORRECTIVE or 0)
+        self.record(BRIGHTNESS_PWM_MAX_RW, cur_pwm_max,
+                    cur_pwm_max != cfg_pwm_max and TELEMETRY_CORRECTIVE or 0)
+        
+        try:
+            flag = False
+            # queue corrective writes and verify PWM range once
+            with mcu.batch(verify=VERIFY_COMMIT) as batch:
+                if not cur_pwm_min == cfg_pwm_min:
+                    flag = True
+                    __mcu_logger__.warning('[%d] %s PWM MIN Read %d (0x%02x). Applying corrective meassures' \
+                                        % (self.pid, self.name, cur_pwm_min, cfg_pwm_min))
+                    batch.write_byte('pwm_min', cfg_pwm_min)
+                    self.record(BRIGHTNESS_PWM_MIN_RW, cfg_pwm_min, corrective)
+                if not cur_pwm_max == cfg_pwm_max:
+                    flag = True
+                    __mcu_logger__.warning('[%d] %s PWM MAX Read %d (0x%02x). Applying corrective meassures' \
+                                        % (self.pid, self.name, cur_pwm_max, cfg_pwm_max))
+                    batch.write_byte('pwm_max', cfg_pwm_max)
+                    self.record(BRIGHTNESS_PWM_MAX_RW, cfg_pwm_max, corrective)
+                # If flag is set, set brightness to default value.
+                # Brightness is only read when it is needed for the log.
+                # In auto mode brightness is left to AutoBrightness.
+                if not flag:
+                    __mcu_logger__.debug('[%s] daemon - all values within threshold,' % self.name)
+                elif self.settings.control_mode == 'static':
+                    cur_brightness = mcu.read_byte('brightness')
+                    self.record(BRIGHTNESS_R, cur_brightness, TELEMETRY_CORRECTIVE)
+                    __mcu_logger__.warning('[%d] %s BRIGHTNESS Read %d (0x%02x). Applying corrective meassures' \
+                                        % (self.pid, self.name, cur_brightness, cfg_brightness))
+                    if not self.settings.ramp_duration:
+                        batch.write_byte('brightness', cfg_brightness)
+                    self.record(BRIGHTNESS_W, cfg_brightness, corrective)
+            # fade instead of snapping to default brightness
+            if flag and self.settings.control_mode == 'static' \
+                    and self.settings.ramp_duration:
+                mcu.ramp_brightness(cfg_brightness, self.settings.ramp_duration,
+                                    self.settings.ramp_max_rate,
+                                    self.settings.brightness_step, wait=False)
+        except BusError, e:
+            __mcu_logger__.critical('[%d] %s corrective meassures failed: %s' \
+                                    % (self.pid, self.name, e.strerror))
+            raise
+        
+        __mcu_logger__.debug('[%s] daemon done performing checks' % self.name)
+        return flag
+
+
+class TelemetryRing(object):
+    '''
+    Fixed size ring buffer of samples, each record holding
+    timestamp, bus, address, register, value and flags.
+    
+    The buffer is a memory map: anonymous when no filename is given,
+    otherwise backed by the file, so history survives restarts
+    without growing beyond capacity records. A file with another
+    capacity or layout is started afresh.
+    '''
+    # magic, version, record size, capacity, next record, records used
+    header = struct.Struct('<4sHHIII')
+    header_size = 32
+    record = struct.Struct('<dBBBBB')
+    magic = 'MCUT'
+    version = 1
+    
+    def __init__(self, capacity, filename=None, readonly=False):
+        self.capacity = capacity
+        self.filename = filename
+        self.lock = threading.Lock()
+        size = self.header_size + capacity * self.record.size
+        if filename is None:
+            self.map = mmap.mmap(-1, size)
+            self.reset()
+            return
+        
+        if readonly:
+            f = open(filename, 'rb')
+            size = os.fstat(f.fileno()).st_size
+            access = mmap.ACCESS_READ
+        else:
+            fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0644)
+            f = os.fdopen(fd, 'r+b')
+            if os.fstat(fd).st_size != size:
+                f.truncate(size)
+            access = mmap.ACCESS_WRITE
+        try:
+            self.map = mmap.mmap(f.fileno(), size, access=access)
+        finally:
+            f.close()
+        
+        magic, version, record_size, capacity, head, count = \
+            self.header.unpack_from(self.map, 0)
+        if readonly:
+            if magic != self.magic or version != self.version or \
+                    record_size != self.record.size:
+                raise IOError(errno.EINVAL, 'not a telemetry file: %s' % filename)
+            self.capacity = capacity
+        elif magic != self.magic or version != self.version or \
+                record_size != self.record.size or capacity != self.capacity:
+            self.reset()
+            return
+        self.head, self.count = head, count
+    
+    def reset(self):
+        self.head = 0
+        self.count = 0
+        self.write_header()
+    
+    def write_header(self):
+        self.header.pack_into(self.map, 0, self.magic, self.version,
+                              self.record.size, self.capacity,
+                              self.head, self.count)
+    
+    def read_header(self):
+        self.head, self.count = self.header.unpack_from(self.map, 0)[4:6]
+    
+    def append(self, timestamp, bus, address, register, value, flags=0):
+        self.lock.acquire()
+        try:
+            self.record.pack_into(self.map,
+                                  self.header_size + self.head * self.record.size,
+                                  timestamp, bus, address, register, value, flags)
+            self.head = (self.head + 1) % self.capacity
+            self.count = min(self.count + 1, self.capacity)
+            self.write_header()
+        finally:
+            self.lock.release()
+    
+    def records(self, since=None, until=None):
+        '''
+        Return records from oldest to newest as a list of
+        (timestamp, bus, address, register, value, flags) tuples,
+        optionally limited to a time window.
+        '''
+        self.lock.acquire()
+        try:
+            self.read_header()
+            start = (self.head - self.count) % self.capacity
+            records = []
+            for i in range(self.count):
+                offset = self.header_size + ((start + i) % self.capacity) * self.record.size
+                record = self.record.unpack_from(self.map, offset)
+                if since is not None and record[0] < since:
+                    continue
+                if until is not None and record[0] > until:
+                    continue
+                records.append(record)
+            return records
+        finally:
+            self.lock.release()
+    
+    def aggregate(self, since=None, until=None):
+        '''
+        Return dict of (bus, address, register) to
+        [samples, min, max, sum, corrective samples]
+        '''
+        result = {}
+        for timestamp, bus, address, register, value, flags in self.records(since, until):
+            key = (bus, address, register)
+            if key not in result:
+                result[key] = [0, value, value, 0, 0]
+            entry = result[key]
+            entry[0] += 1
+            entry[1] = min(entry[1], value)
+            entry[2] = max(entry[2], value)
+            entry[3] += value
+            if flags & TELEMETRY_CORRECTIVE:
+                entry[4] += 1
+        return result
+    
+    def close(self):
+        self.map.close()
+
+
+class StateFile(object):
+    '''
+    Latest known register values of the supervised MCUs, published
+    by the daemon in a memory mapped file of fixed layout, so that
+    local processes can read them without a bus transaction.
+    
+    The file holds slots MCU slots. Each slot has the bus, address
+    and a sequence counter of the MCU, followed by a (timestamp,
+    value, flags) entry per command byte. The writer makes the
+    counter odd while it changes the slot, and even again when done.
+    Readers retry until the counter is the same even number before
+    and after they copied the entry, so they never see a half
+    written value, and never take a lock.
+    
+    Opened by the daemon, the file is cleared in place, so readers
+    keeping it mapped see the new daemon. The daemon invalidates the
+    values again when it stops.
+    '''
+    # magic, version, slots, slot size
+    header = struct.Struct('<4sHHH')
+    header_size = 16
+    # bus, address, unused, sequence counter
+    slot_header = struct.Struct('<BBHI')
+    entry = struct.Struct('<dBB')
+    slot_size = slot_header.size + 256 * entry.size
+    magic = 'MCUS'
+    version = 1
+    
+    def __init__(self, filename, slots=STATE_SLOTS, readonly=False):
+        self.filename = filename
+        self.slots = slots
+        self.lock = threading.Lock()
+        if readonly:
+            f = open(filename, 'rb')
+            size = os.fstat(f.fileno()).st_size
+            access = mmap.ACCESS_READ
+        else:
+            size = self.header_size + slots * self.slot_size
+            fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0644)
+            f = os.fdopen(fd, 'r+b')
+            if os.fstat(fd).st_size != size:
+                f.truncate(size)
+            access = mmap.ACCESS_WRITE
+        try:
+            if size < self.header_size:
+                raise IOError(errno.EINVAL, 'not a state file: %s' % filename)
+            self.map = mmap.mmap(f.fileno(), size, access=access)
+        finally:
+            f.close()
+        
+        if not readonly:
+            self.map[:] = '\0' * size
+            self.header.pack_into(self.map, 0, self.magic, self.version,
+                                  slots, self.slot_size)
+            return
+        magic, version, self.slots, slot_size = self.header.unpack_from(self.map, 0)
+        if magic != self.magic or version != self.version or \
+                slot_size != self.slot_size or \
+                size < self.header_size + self.slots * slot_size:
+            self.map.close()
+            raise IOError(errno.EINVAL, 'not a state file: %s' % filename)
+    
+    def find(self, bus, address):
+        '''
+        Return index of the slot of MCU, or None. Free slots have
+        address 0, the general call address, which is no MCU.
+        '''
+        for index in range(self.slots):
+            slot_bus, slot_address = self.slot_header.unpack_from(
+                self.map, self.header_size + index * self.slot_size)[:2]
+            if (slot_bus, slot_address) == (bus, address):
+                return index
+        return None
+    
+    def slot(self, bus, address):
+        '''
+        Return StateSlot of MCU, taking a free slot if it has none
+        yet. Returns None if all slots are taken.
+        '''
+        self.lock.acquire()
+        try:
+            index = self.find(bus, address)
+            if index is None:
+                index = self.find(0, 0)
+                if index is None:
+                    return None
+                self.slot_header.pack_into(self.map, self.header_size + index * self.slot_size,
+                                           bus, address, 0, 0)
+            return StateSlot(self, index)
+        finally:
+            self.lock.release()
+    
+    def publish(self, index, cmd, value, flags=STATE_VALID, timestamp=None):
+        '''
+        Write entry of command byte cmd in slot index
+        '''
+        if timestamp is None:
+            timestamp = time.time()
+        base = self.header_size + index * self.slot_size
+        self.lock.acquire()
+        try:
+            sequence = self.slot_header.unpack_from(self.map, base)[3]
+            # odd while the entry is being written
+            struct.pack_into('<I', self.map, base + 4, (sequence + 1) & 0xffffffff)
+            self.entry.pack_into(self.map, base + self.slot_header.size + cmd * self.entry.size,
+                                 timestamp, value, flags)
+            struct.pack_into('<I', self.map, base + 4, (sequence + 2) & 0xffffffff)
+        finally:
+            self.lock.release()
+    
+    def read(self, bus, address, cmds=None, retries=100):
+        '''
+        Return dict of command byte to (value, timestamp) of the
+        valid entries of MCU, optionally only those of cmds. Raises
+        IOError with EAGAIN if the daemon kept changing the entries.
+        '''
+        index = self.find(bus, address)
+        if index is None or not address:
+            return {}
+        if cmds is None:
+            cmds = range(256)
+        base = self.header_size + index * self.slot_size
+        for attempt in range(retries):
+            sequence = self.slot_header.unpack_from(self.map, base)[3]
+            if sequence & 1:
+                continue
+            values = {}
+            for cmd in cmds:
+                timestamp, value, flags = self.entry.unpack_from(
+                    self.map, base + self.slot_header.size + cmd * self.entry.size)
+                if flags & STATE_VALID:
+                    values[cmd] = (value, timestamp)
+            if self.slot_header.unpack_from(self.map, base)[3] == sequence:
+                return values
+        raise IOError(errno.EAGAIN, 'register values of 0x%02x on bus %d keep changing'
+                      % (address, bus))
+    
+    def invalidate(self):
+        '''
+        Mark the values of all MCUs unknown, so readers do not take
+        them for current once the daemon is gone
+        '''
+        for index in range(self.slots):
+            base = self.header_size + index * self.slot_size
+            self.lock.acquire()
+            try:
+                sequence = self.slot_header.unpack_from(self.map, base)[3]
+                struct.pack_into('<I', self.map, base + 4, (sequence + 1) & 0xffffffff)
+                start = base + self.slot_header.size
+                self.map[start:start + 256 * self.entry.size] = '\0' * (256 * self.entry.size)
+                struct.pack_into('<I', self.map, base + 4, (sequence + 2) & 0xffffffff)
+            finally:
+                self.lock.release()
+    
+    def registers(self, bus, address, profile=None):
+        '''
+        Return dict of register name to (value, timestamp) of MCU,
+        named after profile, by default the builtin model
+        '''
+        if profile is None:
+            profile = AFL_408B
+        values = self.read(bus, address, profile.read_commands.values())
+        registers = {}
+        for name, cmd in profile.read_commands.iteritems():
+            if cmd in values:
+                registers[name] = values[cmd]
+        return registers
+    
+    def close(self):
+        self.map.close()
+
+
+class StateSlot(object):
+    '''
+    Slot of one MCU in a StateFile, which MCUControl publishes the
+    register values it reads and writes in
+    '''
+    def __init__(self, state, index):
+        self.state = state
+        self.index = index
+    
+    def publish(self, cmd, value):
+        self.state.publish(self.index, cmd, value)
+    
+    def invalidate(self, cmd):
+        '''
+        Mark value of cmd unknown
+        '''
+        self.state.publish(self.index, cmd, 0, 0)
+
+
+class AutoBrightness(object):
+    '''
+    Closed loop brightness controller for the auto control mode.
+    
+    Ambient light samples are smoothed by an ema or median filter,
+    and mapped through the brightness curve, clamped to the PWM
+    thresholds. A new brightness is only asked for when the smoothed
+    light has moved more than lux_hysteresis since the last write,
+    and the brightness differs by at least brightness_deadband, so
+    the bus only sees changes which are perceptible.
+    '''
+    def __init__(self, settings):
+        self.settings = settings
+        self.samples = []
+        self.smoothed = None
+        self.last_lux = None
+        self.last_brightness = None
+    
+    def filter(self, sample):
+        '''
+        Add sample, and return the smoothed ambient light
+        '''
+        if self.settings.lux_filter == 'median':
+            self.samples.append(sample)
+            del self.samples[:-self.settings.lux_filter_window]
+            ordered = sorted(self.samples)
+            self.smoothed = float(ordered[len(ordered) / 2])
+        elif self.smoothed is None:
+            self.smoothed = float(sample)
+        else:
+            alpha = self.settings.lux_filter_alpha
+            self.smoothed += alpha * (sample - self.smoothed)
+        return self.smoothed
+    
+    def brightness(self, lux):
+        '''
+        Map ambient light to brightness through the curve
+        '''
+        curve = self.settings.brightness_curve
+        if lux <= curve[0][0]:
+            value = curve[0][1]
+        elif lux >= curve[-1][0]:
+            value = curve[-1][1]
+        else:
+            index = bisect.bisect_right([point[0] for point in curve], lux)
+            (x0, y0), (x1, y1) = curve[index - 1], curve[index]
+            value = y0 + (y1 - y0) * (lux - x0) / (x1 - x0)
+        value = int(round(value))
+        return max(self.settings.min_pwm_threshold,
+                   min(self.settings.max_pwm_threshold, value))
+    
+    def update(self, sample):
+        '''
+        Add an ambient light sample. Returns the brightness to write,
+        or None if brightness should be left alone.
+        '''
+        lux = self.filter(sample)
+        if self.last_lux is not None and \
+                abs(lux - self.last_lux) <= self.settings.lux_hysteresis:
+            return None
+        brightness = self.brightness(lux)
+        if self.last_brightness is not None and \
+                abs(brightness - self.last_brightness) < self.settings.brightness_deadband:
+            return None
+        self.last_lux = lux
+        self.last_brightness = brightness
+        return brightness
+
+
+class SimulatedMCU(object):
+    '''
+    In-memory model of the AFL-408B MCU register map.
+    
+    Registers are keyed on their read command. Write commands
+    update the register they are read back through, and set the
+    change status register, which is cleared when read.
+    '''
+    def __init__(self):
+        self.registers = {
+            BRIGHTNESS_R : 50,
+            VOLUME_R : 10,
+            FW_VERSION_R : 0x10,
+            FLAG_R : 0x00,
+            FW_TYPE_R : 0x01,
+            BACKLIGHT_R : 0x01,
+            RD_NAME_R : 0x00,
+            FUNCTION_R : 0x00,
+            LUX_MODE_R : 0x00,
+            CHANGE_STATUS_R : 0x00,
+            BRIGHTNESS_PWM_MIN_RW : 0,
+            BRIGHTNESS_PWM_MAX_RW : 100
+        }
+    
+    def read(self, cmd):
+        if cmd not in self.registers:
+            raise IOError(errno.EIO, 'Input/output error')
+        value = self.registers[cmd]
+        if cmd == CHANGE_STATUS_R:
+            self.registers[CHANGE_STATUS_R] = 0
+        return value
+    
+    def write(self, cmd, value):
+        if cmd in AFL_408B.shadow_write:
+            register = AFL_408B.shadow_write[cmd]
+            self.registers[register] = value & 0xff
+        elif cmd in (INCREASE_BRIGHTNESS_W, DECREASE_BRIGHTNESS_W):
+            register = BRIGHTNESS_R
+            step = cmd == INCREASE_BRIGHTNESS_W and 1 or -1
+            self.registers[register] = max(0, min(100, self.registers[register] + step))
+        elif cmd in (INCREASE_VOLUME_W, DECREASE_VOLUME_W):
+            register = VOLUME_R
+            step = cmd == INCREASE_VOLUME_W and 1 or -1
+            self.registers[register] = max(0, min(100, self.registers[register] + step))
+        elif cmd == MUTE_W:
+            register = VOLUME_R
+            self.registers[register] = 0
+        elif cmd in (INVERTER_W, POLLING_W, AUTO_DIMMING_W, KEYPAD_LOCK_W):
+            # accepted, but not modelled
+            return
+        else:
+            raise IOError(errno.EIO, 'Input/output error')
+        self.registers[CHANGE_STATUS_R] |= 0x01
+    
+    def poke(self, cmd, value):
+        '''
+        Change a register behind the daemons back, like the remote
+        control does.
+        '''
+        self.registers[cmd] = value
+        self.registers[CHANGE_STATUS_R] |= 0x01
+
+
+class SimulatedBus(object):
+    '''
+    Drop-in replacement for smbus.SMBus talking to SimulatedMCU
+    instances. MCUs are shared between all SimulatedBus objects
+    opened on the same bus number, like devices on a real bus.
+    
+    Every transaction takes latency seconds, and fails with EIO
+    with probability fault_rate.
+    '''
+    devices = {}
+    
+    def __init__(self, busno, latency=0.0, fault_rate=0.0):
+        self.busno = busno
+        self.latency = latency
+        self.fault_rate = fault_rate
+        self.transactions = 0
+        self.faults = 0
+        import random
+        self.random = random
+    
+    def device(self, address):
+        '''
+        Return the simulated MCU at address, creating it on first use
+        '''
+        key = (self.busno, address)
+        if key not in self.devices:
+            self.devices[key] = SimulatedMCU()
+        return self.devices[key]
+    
+    def _transaction(self):
+        self.transactions += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if self.fault_rate and self.random.random() < self.fault_rate:
+            self.faults += 1
+            raise IOError(errno.EIO, 'Input/output error')
+    
+    def read_byte_data(self, address, cmd):
+        self._transaction()
+        return self.device(address).read(cmd)
+    
+    def write_byte_data(self, address, cmd, value):
+        self._transaction()
+        self.device(address).write(cmd, value)
+    
+    def read_byte_data_combined(self, address, cmds):
+        '''
+        Read several commands in one transaction, like i2c_rdwr
+        '''
+        self._transaction()
+        device = self.device(address)
+        return [device.read(cmd) for cmd in cmds]
+    
+    def close(self):
+        pass
+
+
+def open_bus(busno, backend=None):
+    '''
+    Open /dev/i2c-<busno> through the given bus backend, which
+    defaults to bus_backend from mcuctrl.conf.
+    '''
+    if backend is None:
+        backend = __mcu_settings__.bus_backend
+    if backend == 'sim':
+        return SimulatedBus(busno, __mcu_settings__.sim_latency,
+                            __mcu_settings__.sim_fault_rate)
+    if backend != 'smbus':
+        raise IOError(errno.EINVAL, 'unknown bus backend %s' % backend)
+    if SMBus is None:
+        raise IOError(errno.ENOSYS, 'python smbus module is not installed')
+    return SMBus(busno)
+
+
+class LatencyHistogram(object):
+    '''
+    Latency histogram with fixed, roughly logarithmic buckets.
+    Percentiles are estimated from the bucket bounds and clamped
+    to the exact min and max.
+    '''
+    # bucket upper bounds in seconds, from 10 us to 1 s
+    bounds = (0.00001, 0.00002, 0.00005, 0.0001, 0.0002, 0.0005,
+              0.001, 0.002, 0.005, 0.01, 0.02, 0.05,
+              0.1, 0.2, 0.5, 1.0)
+    
+    def __init__(self):
+        self.buckets = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.min = None
+        self.max = None
+    
+    def add(self, seconds):
+        self.buckets[bisect.bisect_left(self.bounds, seconds)] += 1
+        self.count += 1
+        if self.min is None or seconds < self.min:
+            self.min = seconds
+        if self.max is None or seconds > self.max:
+            self.max = seconds
+    
+    def percentile(self, percent):
+        if not self.count:
+            return None
+        wanted = self.count * percent / 100.0
+        running = 0
+        for i, n in enumerate(self.buckets):
+            running += n
+            if running >= wanted and n:
+                if i == len(self.bounds):
+                    return self.max
+                return max(self.min, min(self.bounds[i], self.max))
+        return self.max
+
+
+class BusStats(object):
+    '''
+    Bus transaction statistics: per command counts, error counts
+    and latency histograms, transaction totals per daemon cycle,
+    and time spent waiting for the bus lock per priority. Shared by
+    all threads.
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.reset()
+    
+    def reset(self):
+        self.lock.acquire()
+        try:
+            self.started = time.time()
+            self.commands = {}
+            self.cycles = 0
+            self.cycle_transactions = 0
+            self.cycle_max = 0
+            self.cycle_latency = LatencyHistogram()
+            self.lock_waits = {}
+        finally:
+            self.lock.release()
+    
+    def record(self, op, cmd, seconds, error=False):
+        '''
+        Record one bus transaction
+        '''
+        self.lock.acquire()
+        try:
+            key = (op, cmd)
+            if key not in self.commands:
+                self.commands[key] = [0, 0, LatencyHistogram()]
+            entry = self.commands[key]
+            entry[0] += 1
+            if error:
+                entry[1] += 1
+            entry[2].add(seconds)
+        finally:
+            self.lock.release()
+        if getattr(self.local, 'cycle', None) is not None:
+            self.local.cycle += 1
+    
+    def record_lock_wait(self, priority, seconds, timed_out=False):
+        '''
+        Record time spent waiting for other threads and processes
+        to release the bus
+        '''
+        self.lock.acquire()
+        try:
+            if priority not in self.lock_waits:
+                self.lock_waits[priority] = [0, LatencyHistogram()]
+            entry = self.lock_waits[priority]
+            if timed_out:
+                entry[0] += 1
+            entry[1].add(seconds)
+        finally:
+            self.lock.release()
+    
+    def begin_cycle(self):
+        '''
+        Start counting transactions of a daemon cycle in this thread
+        '''
+        self.local.cycle = 0
+        self.local.cycle_started = time.time()
+    
+    def end_cycle(self):
+        transactions, self.local.cycle = self.local.cycle, None
+        self.lock.acquire()
+        try:
+            self.cycles += 1
+            self.cycle_transactions += transactions
+            self.cycle_max = max(self.cycle_max, transactions)
+            self.cycle_latency.add(time.time() - self.local.cycle_started)
+        finally:
+            self.lock.release()
+    
+    def total(self):
+        '''
+        Return number of transactions recorded
+        '''
+        self.lock.acquire()
+        try:
+            return sum([entry[0] for entry in self.commands.values()])
+        finally:
+            self.lock.release()
+    
+    def report(self):
+        '''
+        Return statistics as a text table
+        '''
+        def ms(seconds):
+            if seconds is None:
+                return '%8s' % '-'
+            return '%8.3f' % (seconds * 1000)
+        
+        self.lock.acquire()
+        try:
+            lines = ['mcuctrl bus statistics %s, %d seconds' \
+                     % (time.strftime('%Y-%m-%d %H:%M:%S'), time.time() - self.started),
+                     '%-5s %-4s %8s %6s %8s %8s %8s %8s' \
+                     % ('op', 'cmd', 'count', 'errors', 'min ms', 'p50 ms', 'p99 ms', 'max ms')]
+            keys = self.commands.keys()
+            keys.sort()
+            for op, cmd in keys:
+                count, errors, hist = self.commands[(op, cmd)]
+                lines.append('%-5s 0x%02x %8d %6d %s %s %s %s' \
+                             % (op, cmd, count, errors, ms(hist.min),
+                                ms(hist.percentile(50)), ms(hist.percentile(99)),
+                                ms(hist.max)))
+            if self.cycles:
+                lines.append('cycles %d, transactions %d, %.2f per cycle, max %d' \
+                             % (self.cycles, self.cycle_transactions,
+                                float(self.cycle_transactions) / self.cycles,
+                                self.cycle_max))
+                lines.append('cycle duration ms min %s p50 %s p99 %s max %s' \
+                             % (ms(self.cycle_latency.min),
+                                ms(self.cycle_latency.percentile(50)),
+                                ms(self.cycle_latency.percentile(99)),
+                                ms(self.cycle_latency.max)))
+            priorities = self.lock_waits.keys()
+            priorities.sort()
+            for priority in priorities:
+                timeouts, hist = self.lock_waits[priority]
+                lines.append('bus lock wait %s: %d waits, %d timeouts, '
+                             'ms min %s p50 %s p99 %s max %s' \
+                             % (LOCK_PRIORITIES[priority], hist.count, timeouts,
+                                ms(hist.min), ms(hist.percentile(50)),
+                                ms(hist.percentile(99)), ms(hist.max)))
+        finally:
+            self.lock.release()
+        return '\n'.join(lines) + '\n'
+
+
+class InstrumentedBus(object):
+    '''
+    Wraps a bus object, recording every transaction in BusStats,
+    and in trace, a TraceFile, if given. busno is the bus number
+    recorded in the trace.
+    '''
+    def __init__(self, bus, stats, trace=None, busno=0):
+        self.bus = bus
+        self.stats = stats
+        self.trace = trace
+        self.busno = busno
+    
+    def __getattr__(self, name):
+        return getattr(self.bus, name)
+    
+    def read_byte_data(self, address, cmd):
+        start = time.time()
+        try:
+            value = self.bus.read_byte_data(address, cmd)
+        except Exception, e:
+            self.stats.record('read', cmd, time.time() - start, True)
+            if self.trace is not None:
+                self.trace.record(TRACE_READ, self.busno, address, cmd, 0,
+                                  time.time() - start, getattr(e, 'errno', None))
+            raise
+        self.stats.record('read', cmd, time.time() - start)
+        if self.trace is not None:
+            self.trace.record(TRACE_READ, self.busno, address, cmd, value,
+                              time.time() - start)
+        return value
+    
+    def write_byte_data(self, address, cmd, value):
+        start = time.time()
+        try:
+            self.bus.write_byte_data(address, cmd, value)
+        except Exception, e:
+            self.stats.record('write', cmd, time.time() - start, True)
+            if self.trace is not None:
+                self.trace.record(TRACE_WRITE, self.busno, address, cmd, value,
+                                  time.time() - start, getattr(e, 'errno', None))
+            raise
+        self.stats.record('write', cmd, time.time() - start)
+        if self.trace is not None:
+            self.trace.record(TRACE_WRITE, self.busno, address, cmd, value,
+                              time.time() - start)
+    
+    def read_byte_data_combined(self, address, cmds):
+        '''
+        Read a byte from each command in one combined transfer.
+        Uses the bus objects own read_byte_data_combined, or
+        i2c_rdwr from smbus2: a write of the command followed by a
+        one byte read, per command, joined by repeated starts.
+        Raises IOError with EOPNOTSUPP if neither is available.
+        '''
+        start = time.time()
+        try:
+            if hasattr(self.bus, 'read_byte_data_combined'):
+                values = self.bus.read_byte_data_combined(address, cmds)
+            elif i2c_msg is not None and hasattr(self.bus, 'i2c_rdwr'):
+                messages = []
+                reads = []
+                for cmd in cmds:
+                    read = i2c_msg.read(address, 1)
+                    messages.extend([i2c_msg.write(address, [cmd]), read])
+                    reads.append(read)
+                self.bus.i2c_rdwr(*messages)
+                values = [list(read)[0] for read in reads]
+            else:
+                raise IOError(errno.EOPNOTSUPP, 'combined transfers need smbus2')
+        except Exception, e:
+            self.stats.record('rdwr', cmds[0], time.time() - start, True)
+            if self.trace is not None:
+                self.trace.record(TRACE_RDWR, self.busno, address, cmds[0], 0,
+                                  time.time() - start, getattr(e, 'errno', None))
+            raise
+        self.stats.record('rdwr', cmds[0], time.time() - start)
+        if self.trace is not None:
+            # the transfer takes its time once, on the first command
+            duration = time.time() - start
+            for cmd, value in zip(cmds, values):
+                self.trace.record(TRACE_RDWR, self.busno, address, cmd, value, duration)
+                duration = 0.0
+        return values
+
+
+class TraceFile(object):
+    '''
+    Binary trace of bus transactions, as recorded by
+    InstrumentedBus. Each record holds the time, operation
+    (TRACE_READ, TRACE_WRITE or TRACE_RDWR), bus, address, command
+    byte, value, duration in seconds and errno, 0 if the
+    transaction succeeded; 19 bytes in the file.
+    
+    Records are appended to filename with one write each, so
+    several processes can trace to the same file, and nothing is
+    lost if the daemon is killed. Without a filename, records are
+    kept in the records list. clock returns the time recorded.
+    '''
+    header = struct.Struct('<4sHH')
+    record_format = struct.Struct('<dBBBBBfH')
+    magic = 'MCUR'
+    version = 1
+    
+    def __init__(self, filename=None, clock=time.time):
+        self.filename = filename
+        self.clock = clock
+        self.records = []
+        self.fd = None
+        if filename:
+            self.fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0644)
+            if os.fstat(self.fd).st_size == 0:
+                os.write(self.fd, self.header.pack(self.magic, self.version,
+                                                   self.record_format.size))
+    
+    def record(self, op, bus, address, cmd, value, duration, error=0):
+        '''
+        Record a transaction. error is its errno, None if unknown
+        '''
+        if error is None:
+            error = 0xffff
+        record = (self.clock(), op, bus, address, cmd, value & 0xff, duration, error)
+        if self.fd is None:
+            self.records.append(record)
+        else:
+            os.write(self.fd, self.record_format.pack(*record))
+    
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+    
+    def read(cls, filename):
+        '''
+        Return list of (time, op, bus, address, cmd, value, duration,
+        errno) records read from filename. A record cut short at the
+        end of the file is ignored. Raises IOError or ValueError.
+        '''
+        f = open(filename, 'rb')
+        try:
+            data = f.read()
+        finally:
+            f.close()
+        if len(data) < cls.header.size:
+            raise ValueError('%s is not a bus trace' % filename)
+        magic, version, size = cls.header.unpack_from(data)
+        if magic != cls.magic or version != cls.version or \
+                size != cls.record_format.size:
+            raise ValueError('%s is not a version %d bus trace' % (filename, cls.version))
+        records = []
+        for offset in xrange(cls.header.size, len(data) - size + 1, size):
+            records.append(cls.record_format.unpack_from(data, offset))
+        return records
+    
+    read = classmethod(read)
+
+
+class TraceReplay(object):
+    '''
+    Replays the MCU behaviour recorded in a bus trace against the
+    daemon polling logic, on simulated MCUs.
+    
+    A value read in the trace which differs from what the traced
+    transactions before it left in the register was changed behind
+    the daemons back, by the remote control or a misbehaving panel.
+    Those changes are poked into simulated MCUs at their recorded
+    time, while a MCUTarget per traced MCU polls them, configured
+    from settings. The transactions of the replay are traced to
+    self.trace.
+    
+    With speed 0 the replay runs on a virtual clock, as fast as
+    possible. Otherwise it runs in real time, with the trace sped
+    up speed times.
+    '''
+    def __init__(self, records, settings, speed=0):
+        self.speed = speed
+        self.now = 0.0
+        self.trace = TraceFile(clock=lambda: self.now)
+        
+        self.targets = []
+        targets = {}
+        for record in records:
+            key = (record[2], record[3])
+            if key in targets:
+                continue
+            options = {}
+            for target_settings in settings.targets:
+                if (target_settings.mcu_bus, target_settings.mcu_address) == key:
+                    break
+            else:
+                target_settings = settings.targets[0]
+            for option in settings.target_options:
+                options[option] = getattr(target_settings, option)
+            options['mcu_bus'], options['mcu_address'] = key
+            target = MCUTarget(TargetSettings('%d:0x%02x' % key, options),
+                               BusLock(key[0], ''), os.getpid(), trace=self.trace)
+            target.backend = 'sim'
+            targets[key] = target
+            self.targets.append(target)
+        self.changes = self.find_changes(records, targets)
+    
+    def find_changes(self, records, targets):
+        '''
+        Return list of (seconds into the trace, bus, address, read
+        command, value) of the registers changed behind the daemons
+        back.
+        '''
+        changes = []
+        expected = {}
+        records = [record for record in records if not record[7]]
+        records.sort(key=lambda record: record[0])
+        for timestamp, op, bus, address, cmd, value, duration, error in records:
+            profile = targets[(bus, address)].settings.profile
+            key = (bus, address, cmd)
+            if op == TRACE_WRITE:
+                if cmd in profile.shadow_write:
+                    expected[(bus, address, profile.shadow_write[cmd])] = value
+                elif cmd in profile.shadow_invalidate:
+                    expected.pop((bus, address, profile.shadow_invalidate[cmd]), None)
+            elif cmd != profile.read_commands.get('change_status') and \
+                    expected.get(key) != value:
+                changes.append((timestamp - records[0][0], bus, address, cmd, value))
+                expected[key] = value
+        return changes
+    
+    def run(self):
+        '''
+        Replay the trace, and return a dict of results: changes
+        replayed, changes corrected, correction latencies in seconds,
+        transactions and polls. The replay runs until the checks
+        had time to correct the last change.
+        '''
+        SimulatedBus.devices.clear()
+        __mcu_stats__.reset()
+        self.trace.records = []
+        start = monotonic()
+        scale = self.speed or 1.0
+        settle = max([target.settings.check_interval for target in self.targets] + [0])
+        end = start + settle
+        if self.changes:
+            end += self.changes[-1][0] / scale
+        
+        pending = {}
+        latencies = []
+        polls = 0
+        changes = list(self.changes)
+        for target in self.targets:
+            target.next_run = start
+        while self.targets:
+            target = min(self.targets, key=lambda target: target.next_run)
+            if changes and start + changes[0][0] / scale <= target.next_run:
+                when = start + changes[0][0] / scale
+            else:
+                when = target.next_run
+            if when > end:
+                break
+            if self.speed and when > monotonic():
+                time.sleep(when - monotonic())
+            self.now = when
+            
+            if changes and start + changes[0][0] / scale <= target.next_run:
+                offset, bus, address, cmd, value = changes.pop(0)
+                SimulatedBus(bus).device(address).poke(cmd, value)
+                pending[(bus, address, cmd)] = when
+                continue
+            
+            first = len(self.trace.records)
+            target.next_run = target.poll(when)
+            polls += 1
+            # a write through to a changed register corrects it
+            profile = target.settings.profile
+            for record in self.trace.records[first:]:
+                timestamp, op, bus, address, cmd, value, duration, error = record
+                if op != TRACE_WRITE or error or cmd not in profile.shadow_write:
+                    continue
+                changed = pending.pop((bus, address, profile.shadow_write[cmd]), None)
+                if changed is not None:
+                    latencies.append(timestamp - changed)
+        
+        return {'changes' : len(self.changes),
+                'corrected' : len(latencies),
+                'latencies' : latencies,
+                'transactions' : __mcu_stats__.total(),
+                'polls' : polls}
+
+
+class Profiler(object):
+    '''
+    Collects cProfile statistics of sampled calls. Only every
+    every-th call of each function passed to run() is profiled,
+    so profiling can stay
+    on in a running daemon. Each sampled call gets a profile of its
+    own, which is merged into the collected statistics when the call
+    returns, so calls in several threads can be profiled at once.
+    
+    dump() writes the statistics to filename in the pstats format
+    read by standard profile viewers, and summary() reports the
+    time spent per section of PROFILE_SECTIONS.
+    '''
+    def __init__(self, filename, every=1):
+        self.filename = filename
+        self.every = every
+        # function name to number of calls passed to run()
+        self.calls = {}
+        self.sampled = 0
+        self.stats = None
+        self.profile = None
+        self.lock = threading.Lock()
+    
+    def run(self, func, *args, **kwargs):
+        '''
+        Call func, profiling it if it is an every-th call
+        '''
+        calls = self.calls.get(func.__name__, 0)
+        self.calls[func.__name__] = calls + 1
+        if calls % self.every:
+            return func(*args, **kwargs)
+        return self.call(func, *args, **kwargs)
+    
+    def call(self, func, *args, **kwargs):
+        '''
+        Call func and profile it
+        '''
+        import cProfile
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(func, *args, **kwargs)
+        finally:
+            self.add(profile)
+    
+    def start(self):
+        '''
+        Profile the calling thread until stop()
+        '''
+        import cProfile
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+    
+    def stop(self):
+        if self.profile is not None:
+            self.profile.disable()
+            self.add(self.profile)
+            self.profile = None
+    
+    def add(self, profile):
+        import pstats
+        self.lock.acquire()
+        try:
+            self.sampled += 1
+            if self.stats is None:
+                self.stats = pstats.Stats(profile)
+            else:
+                self.stats.add(profile)
+        finally:
+            self.lock.release()
+    
+    def dump(self):
+        '''
+        Write statistics to filename. Raises IOError or OSError.
+        '''
+        self.lock.acquire()
+        try:
+            if self.stats is None:
+                return
+            # write and rename, so viewers never see a partial dump
+            self.stats.dump_stats(self.filename + '.tmp')
+            os.rename(self.filename + '.tmp', self.filename)
+        finally:
+            self.lock.release()
+    
+    def sections(self):
+        '''
+        Return list of (section, calls, seconds) of PROFILE_SECTIONS
+        '''
+        # pstats keys functions by (filename, line, name)
+        keys = {}
+        for section, names in PROFILE_SECTIONS:
+            for name in names:
+                func = globals()[name.split('.')[0]]
+                for attr in name.split('.')[1:]:
+                    func = getattr(func, attr)
+                code = getattr(func, 'im_func', func).func_code
+                keys[(code.co_filename, code.co_firstlineno, code.co_name)] = section
+        
+        totals = {}
+        for key, (cc, nc, tt, ct, callers) in self.stats.stats.iteritems():
+            section = keys.get(key)
+            if section is not None:
+                calls, seconds = totals.get(section, (0, 0.0))
+                totals[section] = (calls + nc, seconds + ct)
+        return [(section,) + totals.get(section, (0, 0.0))
+                for section, names in PROFILE_SECTIONS]
+    
+    def summary(self, limit=10):
+        '''
+        Return time spent per section, and the limit functions
+        taking most time of their own, as a text table
+        '''
+        self.lock.acquire()
+        try:
+            lines = ['mcuctrl profile %s, %d of %d calls sampled' \
+                     % (time.strftime('%Y-%m-%d %H:%M:%S'), self.sampled,
+                        max(sum(self.calls.values()), self.sampled))]
+            if self.stats is None:
+                return lines[0] + '\n'
+            total = self.stats.total_tt
+            lines.append('%-24s %8s %10s %10s %6s' \
+                         % ('section', 'calls', 'total ms', 'per call', '%'))
+            for section, calls, seconds in self.sections():
+                lines.append('%-24s %8d %10.3f %10.3f %5.1f%%' \
+                             % (section, calls, seconds * 1000,
+                                calls and seconds * 1000 / calls or 0,
+                                total and seconds * 100 / total or 0))
+            lines.append('%.3f ms profiled, functions by own time:' % (total * 1000))
+            functions = self.stats.stats.items()
+            functions.sort(key=lambda item: item[1][2], reverse=True)
+            for (filename, line, name), (cc, nc, tt, ct, callers) in functions[:limit]:
+                lines.append('%8d %10.3f %10.3f  %s:%d(%s)' \
+                             % (nc, tt * 1000, ct * 1000,
+                                os.path.basename(filename), line, name))
+        finally:
+            self.lock.release()
+        return '\n'.join(lines) + '\n'
+
+
+class CircuitBreaker(object):
+    '''
+    Stops bus transactions to an unresponsive MCU. After threshold
+    failures in a row the breaker opens, and transactions fail at
+    once for timeout seconds. Then one transaction is let through;
+    its success closes the breaker, its failure opens it again.
+    '''
+    def __init__(self, threshold=5, timeout=30.0):
+        self.threshold = threshold
+        self.timeout = timeout
+        self.failures = 0
+        self.opened = None
+    
+    def allow(self):
+        '''
+        Return True if a transaction may be tried
+        '''
+        return self.opened is None or self.retry_in() == 0
+    
+    def retry_in(self):
+        '''
+        Return seconds until the next transaction is let through
+        '''
+        if self.opened is None:
+            return 0
+        return max(0, self.opened + self.timeout - time.time())
+    
+    def success(self):
+        self.failures = 0
+        self.opened = None
+    
+    def failure(self):
+        '''
+        Count a failed transaction. Returns True if the breaker opened
+        '''
+        self.failures += 1
+        if self.failures >= self.threshold:
+            self.opened = time.time()
+            return True
+        return False
+
+
+class BusLock(object):
+    '''
+    Lock serializing access to one I2C adapter. Within a process it
+    is re-entrant like an RLock. Between processes, the outermost
+    acquire() also takes an advisory lock on a file in bus_lock_dir,
+    so command line invocations and the daemon never interleave
+    their read-compare-write sequences on the bus.
+    
+    Processes waiting for the bus are served by priority: while an
+    interactive process waits, background checks keep off the bus.
+    An interactive waiter holds a shared lock on the pending file;
+    a background waiter only tries the bus lock while it can get an
+    exclusive lock on the pending file. The lock files are only
+    accessible to their owner, so no other user can hold the bus.
+    Waits for other threads and processes are bounded together by
+    timeout, bus_lock_timeout if None, and recorded in the bus
+    statistics. Without a directory only threads are serialized.
+    '''
+    def __init__(self, busno, directory=None, timeout=None):
+        if directory is None:
+            directory = __mcu_settings__.bus_lock_dir
+        self.busno = busno
+        self.directory = directory
+        self.timeout = timeout
+        self.local = threading.Condition(threading.Lock())
+        self.owner = None
+        self.depth = 0
+        # depth at which the bus lock file was locked, if it is
+        self.locked_at = None
+        self.fds = None
+    
+    def open(self):
+        '''
+        Open the lock files. Returns False if they can not be used,
+        locking only between threads from then on.
+        '''
+        if self.fds is None:
+            base = os.path.join(self.directory, 'mcuctrl-i2c-%d' % self.busno)
+            fds = []
+            try:
+                for suffix in ('.pending', '.lock'):
+                    # anyone able to open them could hold the bus
+                    fd = os.open(base + suffix, os.O_RDONLY | os.O_CREAT, 0600)
+                    fds.append(fd)
+                    # created by an older version with mode 0644
+                    st = os.fstat(fd)
+                    if st.st_mode & 0077 and st.st_uid == os.geteuid():
+                        os.fchmod(fd, 0600)
+            except OSError, e:
+                for fd in fds:
+                    os.close(fd)
+                __mcu_logger__.debug('can not lock /dev/i2c-%d against other processes: %s' \
+                                     % (self.busno, e.strerror))
+                self.directory = None
+                return False
+            self.fds = tuple(fds)
+        return True
+    
+    def acquire(self, blocking=True, priority=PRIORITY_INTERACTIVE, arbitrate=True):
+        '''
+        Acquire the lock. Unless arbitrate is False, waits for other
+        processes using the bus as well. Raises BusError with EBUSY
+        if the bus is not released within the timeout. Without
+        arbitrate, other threads are waited for as long as they
+        hold the lock.
+        '''
+        timeout = self.timeout
+        if timeout is None:
+            timeout = __mcu_settings__.bus_lock_timeout
+        started = time.time()
+        deadline = None
+        if arbitrate:
+            deadline = started + timeout
+        me = threading.currentThread()
+        waited = False
+        self.local.acquire()
+        try:
+            if self.owner is not me:
+                while self.owner is not None:
+                    if not blocking:
+                        return False
+                    if deadline is None:
+                        self.local.wait()
+                        continue
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        __mcu_stats__.record_lock_wait(priority, time.time() - started, True)
+                        raise BusError(errno.EBUSY, '/dev/i2c-%d in use by another thread for '
+                                       'more than %.1f seconds' % (self.busno, timeout), True)
+                    self.local.wait(remaining)
+                    waited = True
+                self.owner = me
+            self.depth += 1
+        finally:
+            self.local.release()
+        if arbitrate and self.locked_at is None and self.directory and self.open():
+            try:
+                locked = self.arbitrate(priority, deadline)
+            except:
+                self.leave()
+                raise
+            if not locked:
+                self.leave()
+                __mcu_stats__.record_lock_wait(priority, time.time() - started, True)
+                raise BusError(errno.EBUSY, '/dev/i2c-%d in use by another process for '
+                               'more than %.1f seconds' % (self.busno, timeout), True)
+            self.locked_at = self.depth
+            waited = True
+        if waited:
+            __mcu_stats__.record_lock_wait(priority, time.time() - started)
+        return True
+    
+    def release(self):
+        if self.owner is not threading.currentThread():
+            raise RuntimeError('cannot release un-acquired lock')
+        if self.locked_at == self.depth:
+            import fcntl
+            fcntl.flock(self.fds[1], fcntl.LOCK_UN)
+            self.locked_at = None
+        self.leave()
+    
+    def leave(self):
+        '''
+        Drop one level of the in-process lock, handing it to a
+        waiting thread when it is no longer held
+        '''
+        self.local.acquire()
+        try:
+            self.depth -= 1
+            if not self.depth:
+                self.owner = None
+                self.local.notify()
+        finally:
+            self.local.release()
+    
+    def arbitrate(self, priority, deadline):
+        '''
+        Lock the bus lock file, waiting behind processes of higher
+        priority. Returns False if the bus was not released by
+        deadline.
+        '''
+        import fcntl
+        pending, bus = self.fds
+        delay = 0.0005
+        locked = False
+        if priority == PRIORITY_INTERACTIVE:
+            # announce ourselves to background waiters
+            if self._flock(pending, fcntl.LOCK_SH, deadline):
+                try:
+                    locked = self._flock(bus, fcntl.LOCK_EX, deadline)
+                finally:
+                    fcntl.flock(pending, fcntl.LOCK_UN)
+        else:
+            while True:
+                if self._flock(pending, fcntl.LOCK_EX, None):
+                    try:
+                        locked = self._flock(bus, fcntl.LOCK_EX, None)
+                    finally:
+                        fcntl.flock(pending, fcntl.LOCK_UN)
+                if locked or time.time() >= deadline:
+                    break
+                time.sleep(delay)
+                delay = min(delay * 2, 0.01)
+        return locked
+    
+    def _flock(self, fd, operation, deadline):
+        '''
+        Lock fd, polling until deadline. A deadline of None tries
+        only once. Returns False on timeout.
+        '''
+        import fcntl
+        delay = 0.0005
+        while True:
+            try:
+                fcntl.flock(fd, operation | fcntl.LOCK_NB)
+                return True
+            except IOError, e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES, errno.EINTR):
+                    raise
+            if deadline is None or time.time() >= deadline:
+                return False
+            time.sleep(min(delay, max(0, deadline - time.time())))
+            delay = min(delay * 2, 0.01)
+
+
+BUS_LOCKS = {}
+
+
+def get_bus_lock(busno):
+    '''
+    Return the BusLock of bus, shared by all users of the bus in
+    this process
+    '''
+    return BUS_LOCKS.setdefault(busno, BusLock(busno))
+
+
+class MCUControl(object):
+    '''
+    This class handles reading and writing to the
+    MCU through the python smbus interface.
+    
+    If cache_ttl is given, a shadow register map remembers the last
+    value read or written per command byte. Registers are served
+    from the shadow map according to the cache policy of the model
+    profile; volatile registers are always read from the bus. Use refresh() to force
+    shadowed registers to be re-read.
+    
+    profile is the MCUProfile of the MCU model, which names the
+    registers and their command bytes and value ranges. Every bus
+    transaction is recorded in trace, a TraceFile, if given, and
+    every register value read or written is published in state, a
+    StateSlot, if given.
+    
+    min_pwm_threshold, max_pwm_threshold, backend and profile
+    default to the values from mcuctrl.conf. lock serializes access to the bus
+    between threads and processes, see BusLock, and defaults to the
+    BusLock shared by all MCUControl objects on the same bus. Each
+    write with its PWM range verification holds the lock
+    throughout, so no other writer gets in between.
+    
+    Transactions failing with a transient error are retried with
+    jittered exponential backoff, see bus_retries in MCUSettings,
+    and a CircuitBreaker stops transactions to an MCU which keeps
+    failing. Failed transactions raise BusError.
+    '''
+    def __init__(self, busno=0,
+                 address=0x34, cache_ttl=None,
+                 min_pwm_threshold=None, max_pwm_threshold=None,
+                 backend=None, lock=None, profile=None, trace=None,
+                 state=None):
+        self.busno = busno
+        self.address = address
+        if isinstance(address, basestring):
+            address = int(address, 16)
+        self.addr = address
+        if profile is None:
+            profile = get_profile(__mcu_settings__.mcu_model)
+        self.profile = profile
+        self.trace = trace
+        self.state = state
+        if lock is None:
+            lock = get_bus_lock(int(busno))
+        self.lock = lock
+        self.ramp = None
+        self.min_pwm_threshold = min_pwm_threshold
+        self.max_pwm_threshold = max_pwm_threshold
+        if not cache_ttl:
+            cache_ttl = None
+        self.cache_ttl = cache_ttl
+        self.shadow = {}
+        self.backend = backend
+        self.retries = __mcu_settings__.bus_retries
+        self.retry_delay = __mcu_settings__.bus_retry_delay
+        self.retry_max_delay = __mcu_settings__.bus_retry_max_delay
+        self.breaker = CircuitBreaker(__mcu_settings__.breaker_threshold,
+                                      __mcu_settings__.breaker_timeout)
+        self.snapshot_mode = __mcu_settings__.snapshot_mode
+        # whether the MCU accepts combined transfers, None if not tried
+        self.combined = None
+        self.pending_change = 0
+        self.bus = None
+        self.open()
+    
+    def open(self):
+        '''
+        Open the bus. Raises BusError if it can not be opened.
+        '''
+        try:
+            self.bus = InstrumentedBus(open_bus(int(self.busno), self.backend),
+                                       __mcu_stats__, self.trace, int(self.busno))
+        except IOError, e:
+            message = 'Could not open smbus /dev/i2c-%d. %s' % (int(self.busno), e.args[1])
+            __mcu_logger__.critical(message)
+            raise BusError(e.errno, message, e.errno in TRANSIENT_ERRNOS)
+    
+    def close(self):
+        '''
+        Close the bus handle. It is reopened by the next transaction.
+        '''
+        if self.bus is not None:
+            try:
+                self.bus.close()
+            except IOError:
+                pass
+            self.bus = None
+    
+    def _transaction(self, method, *args):
+        '''
+        Call bus method with the MCU address and args, retrying
+        transient errors. Raises BusError.
+        '''
+        if not self.breaker.allow():
+            raise BusError(errno.EAGAIN, '0x%02x on /dev/i2c-%d not responding, '
+                           'retrying in %d seconds' % (self.addr, int(self.busno),
+                                                       self.breaker.retry_in()), True)
+        delay = self.retry_delay
+        attempt = 0
+        while True:
+            try:
+                if self.bus is None:
+                    self.open()
+                result = getattr(self.bus, method)(self.addr, *args)
+                self.breaker.success()
+                return result
+            except BusError, e:
+                error = e
+            except IOError, e:
+                error = BusError(e.errno, e.strerror or str(e),
+                                 e.errno in TRANSIENT_ERRNOS)
+                if e.errno in REOPEN_ERRNOS:
+                    self.close()
+            attempt += 1
+            if not error.transient or attempt > self.retries:
+                if self.breaker.failure():
+                    __mcu_logger__.error('0x%02x on /dev/i2c-%d not responding, '
+                                         'leaving it alone for %d seconds' \
+                                         % (self.addr, int(self.busno),
+                                            self.breaker.timeout))
+                raise error
+            __mcu_logger__.debug('%s 0x%02x failed: %s, retry %d of %d' \
+                                 % (method, args[0], error.strerror, attempt, self.retries))
+            import random
+            time.sleep(delay * random.uniform(0.5, 1.5))
+            delay = min(delay * 2, self.retry_max_delay)
+    
+    def _cache_get(self, cmd_value):
+        '''
+        Return shadowed value for read command, or None if the
+        register is not cached or the cached value has expired.
+        '''
+        if self.cache_ttl is None:
+            return None
+        policy = self.profile.cache_policy.get(cmd_value, CACHE_NEVER)
+        if policy == CACHE_NEVER or cmd_value not in self.shadow:
+            return None
+        value, stamp = self.shadow[cmd_value]
+        if policy == CACHE_TTL and time.time() - stamp > self.cache_ttl:
+            del self.shadow[cmd_value]
+            return None
+        return value
+    
+    def _cache_put(self, cmd_value, value):
+        '''
+        Remember value for read command, if its policy allows it
+        '''
+        if self.cache_ttl is None:
+            return
+        if self.profile.cache_policy.get(cmd_value, CACHE_NEVER) != CACHE_NEVER:
+            self.shadow[cmd_value] = (value, time.time())
+    
+    def _known(self, cmd_value, value):
+        '''
+        Remember value of read command read from or written to the
+        bus, and publish it
+        '''
+        self._cache_put(cmd_value, value)
+        if self.state is not None:
+            self.state.publish(cmd_value, value)
+    
+    def _write(self, cmd_value, value):
+        '''
+        Write value to the bus and keep the shadow map in sync
+        '''
+        self._transaction('write_byte_data', cmd_value, value)
+        if cmd_value in self.profile.shadow_write:
+            self._known(self.profile.shadow_write[cmd_value], value)
+        elif cmd_value in self.profile.shadow_invalidate:
+            register = self.profile.shadow_invalidate[cmd_value]
+            self.shadow.pop(register, None)
+            if self.state is not None:
+                self.state.invalidate(register)
+    
+    def invalidate(self):
+        '''
+        Drop all shadowed register values
+        '''
+        self.shadow.clear()
+    
+    def refresh(self, *cmds):
+        '''
+        Re-read registers from the bus, bypassing the shadow map.
+        Without arguments all currently shadowed registers are
+        re-read. Returns a dict of command name or byte to value.
+        '''
+        values = {}
+        self.lock.acquire()
+        try:
+            if cmds:
+                for cmd in cmds:
+                    values[cmd] = self.read_byte(cmd, cached=False)
+            else:
+                for cmd_value in self.shadow.keys():
+                    value = self._transaction('read_byte_data', cmd_value)
+                    self._known(cmd_value, value)
+                    values[cmd_value] = value
+        finally:
+            self.lock.release()
+        return values
+            
+    def read_byte(self, cmd, cached=True):
+        '''
+        Return value of read command cmd. Raises ValueError for an
+        unknown command, and BusError.
+        '''
+        if cmd not in self.profile.read_commands:
+            raise ValueError('Command not found: %s' % cmd)
+        try:
+            cmd_value = self.profile.read_commands[cmd]
+            retval = None
+            if cached:
+                retval = self._cache_get(cmd_value)
+            if retval is None:
+                self.lock.acquire()
+                try:
+                    retval = self._transaction('read_byte_data', cmd_value)
+                    self._known(cmd_value, retval)
+                finally:
+                    self.lock.release()
+            if cmd == 'change_status':
+                # include changes a snapshot has already cleared
+                retval |= self.pending_change
+                self.pending_change = 0
+        except BusError, e:
+            __mcu_logger__.error('Reading %s failed: %s' % (cmd, e.strerror))
+            raise
+
+        return retval
+    
+    def snapshot(self, names=SNAPSHOT_REGISTERS, cached=True):
+        '''
+        Read registers together and return a MCUSnapshot.
+        
+        Registers not served from the shadow map are read in one
+        combined i2c_rdwr transfer if the bus and MCU support it,
+        see snapshot_mode in MCUSettings, otherwise by byte reads
+        back-to-back. The bus lock is held throughout, so no other
+        thread writes in between. Raises BusError.
+        '''
+        read_commands = self.profile.read_commands
+        values = {}
+        pending = []
+        transactions = 0
+        self.lock.acquire()
+        try:
+            for name in names:
+                if name not in read_commands:
+                    raise ValueError('Command not found: %s' % name)
+                cmd_value = read_commands[name]
+                value = None
+                if cached:
+                    value = self._cache_get(cmd_value)
+                if value is None:
+                    pending.append(cmd_value)
+                else:
+                    values[name] = value
+            
+            results = None
+            if pending and self.use_combined():
+                try:
+                    results = self._transaction('read_byte_data_combined', pending)
+                    transactions = 1
+                    self.combined = True
+                except BusError, e:
+                    # once combined transfers worked, only a bus which
+                    # can not do them at all makes us fall back
+                    if self.snapshot_mode == 'combined' or \
+                            (self.combined and e.errno != errno.EOPNOTSUPP):
+                        raise
+                    __mcu_logger__.info('0x%02x does not accept combined transfers (%s), '
+                                        'using byte reads' % (self.addr, e.strerror))
+                    self.combined = False
+            if results is None:
+                results = []
+                for cmd_value in pending:
+                    results.append(self._transaction('read_byte_data', cmd_value))
+                transactions = len(pending)
+            
+            change_status = read_commands.get('change_status')
+            for cmd_value, value in zip(pending, results):
+                self._known(cmd_value, value)
+                if cmd_value == change_status:
+                    # keep the flag for the next change status read
+                    self.pending_change |= value
+            for name in names:
+                if name not in values:
+                    values[name] = results[pending.index(read_commands[name])]
+        finally:
+            self.lock.release()
+        
+        return MCUSnapshot(int(self.busno), self.addr, time.time(),
+                           values, transactions)
+    
+    def use_combined(self):
+        '''
+        Return True if snapshot() should try a combined transfer
+        '''
+        if self.snapshot_mode == 'bytes':
+            return False
+        if self.snapshot_mode == 'combined':
+            return True
+        return self.combined is not False
+    
+    def write_byte(self, cmd, value, verify=True):
+        '''
+        Write value to MCU. Unless verify is False, make sure the
+        PWM min and max thresholds are still in range afterwards.
+        Raises ValueError for an unknown command, or if value is out
+        of the register's range.
+        '''
+        cmd_value, value = self.check_write(cmd, value)
+        self.lock.acquire()
+        try:
+            try:
+                # save new settings
+                if cmd_value in self.profile.ramp_commands:
+                    # a new brightness overrides any fade in progress
+                    self.cancel_ramp()
+                self._write(cmd_value, value)
+                __mcu_logger__.info('Wrote %s value %d (0x%02x)' % (cmd, value, value))
+            except BusError, e:
+                __mcu_logger__.error('Writing %s failed: %s' % (cmd, e.strerror))
+                raise
+            
+            if verify:
+                self.verify_pwm_range()
+        finally:
+            self.lock.release()
+
+        return True
+    
+    def check_write(self, cmd, value):
+        '''
+        Return command byte of write command cmd and value as an
+        int. Raises ValueError for an unknown command, or if value
+        is out of the register's range.
+        '''
+        if cmd not in self.profile.write_commands:
+            raise ValueError('Command not found: %s' % cmd)
+        cmd_value, minimum, maximum = self.profile.write_commands[cmd]
+        value = int(value)
+        if not minimum <= value <= maximum:
+            raise ValueError('%s value %d out of range %d-%d' \
+                             % (cmd, value, minimum, maximum))
+        return cmd_value, value
+    
+    def verify_pwm_range(self):
+        '''
+        Make sure min and max pwm thresholds always are in range.
+        Out of range values are replaced by the thresholds, holding
+        the bus lock from the read to the writes. Raises BusError.
+        '''
+        cfg_pwm_min = self.min_pwm_threshold
+        if cfg_pwm_min is None:
+            cfg_pwm_min = __mcu_settings__.min_pwm_threshold
+        cfg_pwm_max = self.max_pwm_threshold
+        if cfg_pwm_max is None:
+            cfg_pwm_max = __mcu_settings__.max_pwm_threshold
+        
+        self.lock.acquire()
+        try:
+            current = self.snapshot(('pwm_min', 'pwm_max'))
+            if current.pwm_min < cfg_pwm_min:
+                self._write(self.profile.registers['pwm_min'].write, cfg_pwm_min)
+                __mcu_logger__.warning('PWM MIN out of defined range: Wrote new value %d (0x%02x)' \
+                                    % (cfg_pwm_min, cfg_pwm_min))
+            if current.pwm_max > cfg_pwm_max:
+                self._write(self.profile.registers['pwm_max'].write, cfg_pwm_max)
+                __mcu_logger__.warning('PWM MAX out of defined range: Wrote new value %d (0x%02x)' \
+                                    % (cfg_pwm_max, cfg_pwm_max))
+        finally:
+            self.lock.release()
+    
+    def batch(self, verify=VERIFY_COMMIT):
+        '''
+        Return a MCUBatch which queues writes and issues them
+        back-to-back when committed. Use as a context manager:
+        
+            with mcu.batch() as batch:
+                batch.write_byte('pwm_min', 30)
+                batch.write_byte('brightness', 18)
+        '''
+        return MCUBatch(self, verify)
+    
+    def ramp_brightness(self, target, duration, max_rate=20, step=1, wait=True):
+        '''
+        Fade brightness to target over duration seconds, writing at
+        most max_rate times per second. step is the number of units
+        one increase or decrease brightness command moves. A fade
+        in progress is cancelled. Unless wait is True, the fade runs
+        in a thread of its own, and the BrightnessRamp is returned.
+        Raises ValueError if target is out of the brightness range,
+        and BusError if waiting for the fade.
+        '''
+        # steps are written without write_byte's range check, and
+        # would wrap around to 8 bits
+        target = self.check_write('brightness', target)[1]
+        self.cancel_ramp()
+        self.ramp = BrightnessRamp(self, target, duration, max_rate, step)
+        if wait:
+            self.ramp.fade()
+        else:
+            self.ramp.start()
+        return self.ramp
+    
+    def cancel_ramp(self):
+        '''
+        Stop a fade in progress, leaving brightness where it is
+        '''
+        ramp = self.ramp
+        if ramp is not None and ramp is not threading.currentThread():
+            ramp.cancel()
+
+
+class MCUSnapshot(object):
+    '''
+    Register values of one MCU, read together by
+    MCUControl.snapshot(). Values are attributes named after the
+    read commands, or looked up by name: snapshot['pwm_min'].
+    Read-only.
+    '''
+    def __init__(self, busno, address, timestamp, values, transactions=0):
+        self.busno = busno
+        self.address = address
+        self.timestamp = timestamp
+        self._values = values.copy()
+        self.transactions = transactions
+        self._frozen = True
+    
+    def __getattr__(self, name):
+        # only called for attributes not set in __init__
+        try:
+            return self.__dict__['_values'][name]
+        except KeyError:
+            raise AttributeError(name)
+    
+    def __getitem__(self, name):
+        return self._values[name]
+    
+    def as_dict(self):
+        return self._values.copy()
+    
+    def __setattr__(self, name, value):
+        if getattr(self, '_frozen', False):
+            raise AttributeError('snapshot is read-only')
+        object.__setattr__(self, name, value)
+    
+    def names(self):
+        '''
+        Return register names in SNAPSHOT_REGISTERS order
+        '''
+        names = [n for n in SNAPSHOT_REGISTERS if n in self._values]
+        others = [n for n in self._values if n not in SNAPSHOT_REGISTERS]
+        others.sort()
+        return names + others
+
+
+class BrightnessRamp(threading.Thread):
+    '''
+    Moves brightness to a target in evenly timed steps.
+    
+    Each step is written with whichever command needs fewer bus
+    transactions: one absolute brightness write, or as many
+    increase/decrease brightness commands as the step needs. On a
+    tie the relative command is used; it moves brightness the way
+    the remote control does, and does not override a concurrent
+    remote control change with a stale absolute value. The PWM
+    range is verified once, when the fade is done.
+    '''
+    def __init__(self, mcu, target, duration, max_rate=20, step=1):
+        threading.Thread.__init__(self, name='ramp')
+        self.setDaemon(True)
+        self.mcu = mcu
+        self.target = target
+        self.duration = duration
+        self.max_rate = max_rate
+        self.step = step
+        self.cancelled = threading.Event()
+        self.transactions = 0
+    
+    def cancel(self):
+        self.cancelled.set()
+    
+    def plan(self, start):
+        '''
+        Return list of (command, value) writes moving brightness
+        from start to target. Every write counts as one transaction.
+        '''
+        delta = self.target - start
+        if not delta:
+            return []
+        # spread the change over as many steps as the rate allows,
+        # but never more steps than there are brightness units
+        steps = min(abs(delta), max(1, int(self.duration * self.max_rate)))
+        commands = self.mcu.profile.write_commands
+        relative = 'inc_brightness' in commands and 'dec_brightness' in commands
+        writes = []
+        position = start
+        for i in range(1, steps + 1):
+            value = start + int(round(delta * float(i) / steps))
+            move = value - position
+            # an absolute write always costs one transaction, the
+            # relative commands one per step, if they can hit value
+            relative_cost = None
+            if relative and move % self.step == 0:
+                relative_cost = abs(move) / self.step
+            if relative_cost is not None and relative_cost <= 1:
+                command = move > 0 and 'inc_brightness' or 'dec_brightness'
+                writes.extend([(commands[command][0], 0)] * (abs(move) / self.step))
+            else:
+                writes.append((commands['brightness'][0], value))
+            position = value
+        return writes
+    
+    def run(self):
+        try:
+            self.fade()
+        except BusError, e:
+            __mcu_logger__.error('brightness fade aborted: %s' % e.strerror)
+    
+    def fade(self):
+        self.mcu.lock.acquire()
+        try:
+            start = self.mcu.read_byte('brightness')
+        finally:
+            self.mcu.lock.release()
+        writes = self.plan(start)
+        if not writes:
+            return
+        
+        __mcu_logger__.info('fading brightness %d -> %d in %d writes over %.1f seconds' \
+                            % (start, self.target, len(writes), self.duration))
+        interval = max(float(self.duration) / len(writes), 1.0 / self.max_rate)
+        began = time.time()
+        for i, (command, value) in enumerate(writes):
+            self.mcu.lock.acquire()
+            try:
+                # checked with the lock held: a write which cancelled
+                # the fade while we waited for the lock must not be
+                # followed by a stale step
+                if self.cancelled.isSet():
+                    __mcu_logger__.debug('brightness fade cancelled')
+                    return
+                self.mcu._write(command, value)
+                self.transactions += 1
+            finally:
+                self.mcu.lock.release()
+            # steps are timed from the start, so slow writes do not
+            # stretch the fade
+            remaining = began + (i + 1) * interval - time.time()
+            if remaining > 0 and i + 1 < len(writes):
+                self.cancelled.wait(remaining)
+        
+        self.mcu.lock.acquire()
+        try:
+            self.mcu.verify_pwm_range()
+        finally:
+            self.mcu.lock.release()
+
+
+class MCUBatch(object):
+    '''
+    Queue of writes to a MCUControl, committed in one go.
+    
+    verify selects when the PWM range is verified:
+    VERIFY_ALWAYS after every write, VERIFY_COMMIT once after
+    all writes or VERIFY_NEVER.
+    '''
+    def __init__(self, mcu, verify=VERIFY_COMMIT):
+        if verify not in (VERIFY_ALWAYS, VERIFY_COMMIT, VERIFY_NEVER):
+            raise ValueError('unknown verify policy: %s' % verify)
+        self.mcu = mcu
+        self.verify = verify
+        self.writes = []
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        # only commit if the with block finished cleanly
+        if exc_type is None:
+            self.commit()
+        else:
+            self.discard()
+        return False
+    
+    def write_byte(self, cmd, value):
+        '''
+        Queue a write. Nothing is written before commit(). Raises
+        ValueError for an unknown command or a value out of range,
+        so a bad write never leaves the batch half committed.
+        '''
+        value = self.mcu.check_write(cmd, value)[1]
+        self.writes.append((cmd, value))
+    
+    def discard(self):
+        '''
+        Drop all queued writes
+        '''
+        self.writes = []
+    
+    def commit(self):
+        '''
+        Issue queued writes back-to-back and verify the PWM range
+        according to the verify policy, also when a write failed
+        after others were issued. The bus lock is held throughout.
+        '''
+        writes, self.writes = self.writes, []
+        issued = 0
+        self.mcu.lock.acquire()
+        try:
+            try:
+                for cmd, value in writes:
+                    issued += 1
+                    self.mcu.write_byte(cmd, value,
+                                        verify=self.verify == VERIFY_ALWAYS)
+            finally:
+                if issued and self.verify == VERIFY_COMMIT:
+                    self.mcu.verify_pwm_range()
+        finally:
+            self.mcu.lock.release()
+        return len(writes)
+    
+
+class ControlServer(object):
+    '''
+    UNIX domain socket through which CLI invocations are served by
+    the running daemon, reusing its open bus handle and shadow
+    register cache.
+    
+    The protocol is line based. Each request is one line, and is
+    answered by one line starting with ok or error:
+    
+        target <bus> <address>              -> ok
+        read <cmd>                          -> ok <value>
+        write <cmd> <value>                 -> ok
+        batch <verify> <cmd>=<value> ...    -> ok <number of writes>
+        ramp <brightness> <seconds>         -> ok
+    
+    A ramp request starts a brightness fade and answers right away.
+    Requests go to the first supervised MCU, until another one is
+    selected with a target request. Only the owner of the daemon
+    may connect; the socket is created with mode 0600.
+    '''
+    def __init__(self, path, targets):
+        self.path = path
+        self.targets = targets
+        self.target = targets[0]
+        
+        # remove socket left behind by a daemon that was killed
+        if os.path.exists(path):
+            os.remove(path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # the daemon runs with umask 0, which would let any local
+        # user write to the MCU through the socket
+        umask = os.umask(0177)
+        try:
+            self.sock.bind(path)
+        finally:
+            os.umask(umask)
+        self.sock.listen(5)
+        __mcu_logger__.debug('listening on control socket %s' % path)
+    
+    def serve(self, timeout):
+        '''
+        Serve requests until timeout seconds have passed, or a
+        signal is received
+        '''
+        deadline = time.time() + timeout
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                readable = select.select([self.sock], [], [], remaining)[0]
+            except select.error:
+                # interrupted by a signal, let the caller handle it
+                break
+            if readable:
+                self.handle_connection()
+    
+    def handle_connection(self):
+        '''
+        Answer requests from one client until it disconnects
+        '''
+        try:
+            conn = self.sock.accept()[0]
+        except socket.error, e:
+            __mcu_logger__.error('control socket: %s' % e)
+            return
+        
+        # a stuck client must never hold up the daemon
+        conn.settimeout(1.0)
+        self.target = self.targets[0]
+        stream = conn.makefile('r+b')
+        try:
+            try:
+                for line in stream:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    stream.write(self.handle(line) + '\n')
+                    stream.flush()
+            except socket.error, e:
+                __mcu_logger__.debug('control socket: %s' % e)
+        finally:
+            stream.close()
+            conn.close()
+    
+    def handle(self, line):
+        '''
+        Process one request and return the response line
+        '''
+        args = line.split()
+        if args[0] == 'target' and len(args) == 3:
+            try:
+                busno, address = int(args[1]), int(args[2], 16)
+            except ValueError, e:
+                return 'error %s' % e
+            for target in self.targets:
+                if target.busno == busno and target.address == address:
+                    self.target = target
+                    return 'ok'
+            return 'error not supervised: %s' % line
+        
+        # hold the bus lock so requests do not interleave with polls
+        try:
+            self.target.lock.acquire()
+        except BusError, e:
+            return 'error %s' % e.strerror
+        try:
+            return self.handle_mcu(self.target, args, line)
+        finally:
+            self.target.lock.release()
+    
+    def handle_mcu(self, target, args, line):
+        try:
+            mcu = target.open()
+            if args[0] == 'read' and len(args) == 2:
+                return 'ok %d' % mcu.read_byte(args[1])
+            elif args[0] == 'write' and len(args) == 3:
+                mcu.write_byte(args[1], int(args[2]))
+                return 'ok'
+            elif args[0] == 'batch' and len(args) > 1:
+                batch = mcu.batch(verify=args[1])
+                for arg in args[2:]:
+                    cmd, value = arg.split('=', 1)
+                    batch.write_byte(cmd, int(value))
+                return 'ok %d' % batch.commit()
+            elif args[0] == 'snapshot':
+                snapshot = mcu.snapshot(args[1:] or SNAPSHOT_REGISTERS)
+                return 'ok %s' % ' '.join(['%s=%d' % (name, snapshot[name])
+                                           for name in snapshot.names()])
+            elif args[0] == 'ramp' and len(args) == 3:
+                mcu.ramp_brightness(int(args[1]), float(args[2]),
+                                    target.settings.ramp_max_rate,
+                                    target.settings.brightness_step, wait=False)
+                return 'ok'
+            return 'error invalid request: %s' % line
+        except BusError, e:
+            return 'error %s' % e.strerror
+        except ValueError, e:
+            return 'error %s' % e
+    
+    def close(self):
+        '''
+        Close and remove the control socket
+        '''
+        self.sock.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class ControlClient(object):
+    '''
+    Client side of the daemon control socket. Offers the same
+    read_byte/write_byte calls as MCUControl.
+    '''
+    def __init__(self, path, timeout=5.0):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        self.sock.connect(path)
+        self.stream = self.sock.makefile('r+b')
+        self.busno = None
+        self.address = None
+    
+    def connect(cls, path):
+        '''
+        Return a client connected to the running daemon, or None
+        if the daemon is not running.
+        '''
+        if not path or not os.path.exists(path):
+            return None
+        try:
+            return cls(path)
+        except socket.error:
+            return None
+    
+    connect = classmethod(connect)
+    
+    def request(self, line):
+        '''
+        Send one request and return the response. Raises IOError
+        if the daemon answers with an error.
+        '''
+        self.stream.write(line + '\n')
+        self.stream.flush()
+        response = self.stream.readline().strip()
+        if not response.startswith('ok'):
+            raise IOError(0, response[len('error '):] or 'no response from daemon')
+        return response[len('ok '):]
+    
+    def select(self, busno, address):
+        '''
+        Direct following requests to the MCU at busno/address,
+        address given as a hexadecimal string
+        '''
+        self.request('target %d %s' % (int(busno), address))
+        self.busno = int(busno)
+        self.address = int(address, 16)
+    
+    def read_byte(self, cmd):
+        return int(self.request('read %s' % cmd))
+    
+    def write_byte(self, cmd, value):
+        self.request('write %s %d' % (cmd, int(value)))
+        return True
+    
+    def batch(self, writes, verify=VERIFY_COMMIT):
+        '''
+        Commit a list of (cmd, value) writes in one request
+        '''
+        args = ['%s=%d' % (cmd, int(value)) for cmd, value in writes]
+        return int(self.request('batch %s %s' % (verify, ' '.join(args))))
+    
+    def snapshot(self, names=()):
+        '''
+        Return a MCUSnapshot taken by the daemon
+        '''
+        values = {}
+        for arg in self.request(' '.join(('snapshot',) + tuple(names))).split():
+            name, value = arg.split('=', 1)
+            values[name] = int(value)
+        return MCUSnapshot(self.busno, self.address, time.time(), values)
+    
+    def ramp_brightness(self, target, duration):
+        '''
+        Start a brightness fade in the daemon
+        '''
+        self.request('ramp %d %f' % (int(target), float(duration)))
+    
+    def close(self):
+        self.stream.close()
+        self.sock.close()
+
+
+def get_control_client(busno, address):
+    '''
+    Return a ControlClient if the daemon is running and supervises
+    the MCU at busno/address, otherwise None.
+    '''
+    client = ControlClient.connect(__mcu_settings__.control_socket)
+    if client is None:
+        return None
+    try:
+        client.select(busno, address)
+    except (IOError, socket.error):
+        client.close()
+        return None
+    return client
+    
+
+class QueuedLogger(object):
+    '''
+    Front end to a logging.Logger which never blocks the caller on
+    the logfile. Records are queued and written, and logfiles
+    rotated, by a background thread.
+    
+    A message repeated within repeat_interval seconds of its first
+    occurrence is counted instead of written, and summarized once
+    the interval is over. Writes are sampled by profiler, if set.
+    '''
+    # levels as in the logging module
+    DEBUG = 10
+    INFO = 20
+    WARNING = 30
+    ERROR = 40
+    CRITICAL = 50
+    
+    def __init__(self, logger, queue_size=1000, repeat_interval=60):
+        self.logger = logger
+        self.queue_size = queue_size
+        self.repeat_interval = repeat_interval
+        self.lock = threading.Lock()
+        self.pid = None
+        self.queue = None
+        self.thread = None
+        self.dropped = 0
+        self.profiler = None
+        atexit.register(self.close)
+    
+    def start(self):
+        '''
+        Start the writer thread. Threads do not survive fork, so
+        this is done again in a forked daemon.
+        '''
+        import Queue
+        self.full = Queue.Full
+        self.empty = Queue.Empty
+        self.queue = Queue.Queue(self.queue_size)
+        # (level, message) to [first, repeats, last]
+        self.repeated = {}
+        self.pid = os.getpid()
+        self.thread = threading.Thread(target=self.run, name='logger')
+        self.thread.setDaemon(True)
+        self.thread.start()
+    
+    def log(self, level, msg):
+        if not self.logger.isEnabledFor(level):
+            return
+        if self.pid != os.getpid():
+            self.lock.acquire()
+            try:
+                if self.pid != os.getpid():
+                    self.start()
+            finally:
+                self.lock.release()
+        try:
+            self.queue.put_nowait((level, msg, time.time()))
+        except self.full:
+            self.dropped += 1
+    
+    def debug(self, msg):
+        self.log(self.DEBUG, msg)
+    
+    def info(self, msg):
+        self.log(self.INFO, msg)
+    
+    def warning(self, msg):
+        self.log(self.WARNING, msg)
+    
+    def error(self, msg):
+        self.log(self.ERROR, msg)
+    
+    def critical(self, msg):
+        self.log(self.CRITICAL, msg)
+    
+    def setLevel(self, level):
+        self.logger.setLevel(level)
+    
+    def run(self):
+        while True:
+            try:
+                item = self.queue.get(True, 1.0)
+            except self.empty:
+                item = ()
+            if item is None:
+                self.expire(None)
+                return
+            if item and self.profiler is not None:
+                self.profiler.run(self.write, *item)
+            elif item:
+                self.write(*item)
+            if self.dropped:
+                dropped, self.dropped = self.dropped, 0
+                self.emit(self.WARNING, 'log queue full, dropped %d messages' % dropped,
+                          time.time())
+            self.expire(time.time())
+    
+    def write(self, level, msg, created):
+        if self.repeat_interval:
+            key = (level, msg)
+            entry = self.repeated.get(key)
+            if entry is not None:
+                if created - entry[0] < self.repeat_interval:
+                    entry[1] += 1
+                    entry[2] = created
+                    return
+                self.summarize(key, entry)
+            self.repeated[key] = [created, 0, created]
+        self.emit(level, msg, created)
+    
+    def expire(self, now):
+        '''
+        Summarize and forget messages whose repeat interval is
+        over, or all of them if now is None
+        '''
+        for key, entry in self.repeated.items():
+            if now is None or now - entry[0] >= self.repeat_interval:
+                self.summarize(key, entry)
+                del self.repeated[key]
+    
+    def summarize(self, key, entry):
+        first, repeats, last = entry
+        if repeats:
+            self.emit(key[0], '%s (repeated %d times in %d s)' \
+                      % (key[1], repeats, int(round(last - first))), last)
+    
+    def emit(self, level, msg, created):
+        '''
+        Write record with the time it was logged, not written
+        '''
+        record = self.logger.makeRecord(self.logger.name, level, '', 0,
+                                        msg, (), None)
+        record.created = created
+        record.msecs = (created - int(created)) * 1000
+        self.logger.handle(record)
+    
+    def close(self):
+        '''
+        Write queued records and stop the writer thread. Records
+        logged afterwards start a new one.
+        
+        Call this before fork: a writer thread caught holding a
+        handler lock would leave the lock held in the child.
+        '''
+        if self.pid != os.getpid() or not self.thread.isAlive():
+            return
+        try:
+            self.queue.put(None, True, 1.0)
+        except self.full:
+            return
+        self.thread.join(5.0)
+        self.pid = None
+
+
+class LazyObject(object):
+    '''
+    Stand-in for an object which is created by factory on first
+    attribute access. All attribute access is passed on to the
+    created object.
+    '''
+    def __init__(self, factory):
+        object.__setattr__(self, '_factory', factory)
+        object.__setattr__(self, '_object', None)
+    
+    def _get(self):
+        obj = object.__getattribute__(self, '_object')
+        if obj is None:
+            obj = object.__getattribute__(self, '_factory')()
+            object.__setattr__(self, '_object', obj)
+        return obj
+    
+    def _set(self, obj):
+        '''
+        Replace the object. Other threads see either the old or
+        the new object, never a mix.
+        '''
+        object.__setattr__(self, '_object', obj)
+    
+    def __getattr__(self, name):
+        return getattr(self._get(), name)
+    
+    def __setattr__(self, name, value):
+        setattr(self._get(), name, value)
+
+
+def get_settings():
+    '''
+    Return settings from mcuctrl.conf. Used as a library, mcuctrl
+    falls back to the default settings if there is no config file;
+    the command line insists on one.
+    '''
+    if __name__ != '__main__' and not os.path.exists(CONFIG_FILE):
+        return MCUSettings.default()
+    return MCUSettings()
+
+
+# Global objects.
+# Settings and logger are created on first use, so importing the
+# module, or running a command which does not need them, does not
+# read mcuctrl.conf or open the logfile.
+__mcu_settings__ = LazyObject(get_settings)
+__mcu_stats__ = BusStats()
+__mcu_logger__ = LazyObject(MCUSettings.get_logger)
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+    from optparse import OptionGroup
+    from optparse import OptionValueError
+    
+    # MCU handles opened by the command line options, shared by
+    # all options naming the same bus and address
+    mcu_handles = {}
+    # results of read and write options, for --format json or csv
+    results = []
+    # profiler started by --profile
+    profiling = []
+    # read, write and other operations, run once all options are
+    # parsed
+    operations = []
+    
+    def check_target(parser, option):
+        '''
+        Make sure bus and address are given before option
+        '''
+        if not parser.values.bus:
+            raise OptionValueError('must set bus number before %s option' % option)
+        if not parser.values.addr:
+            raise OptionValueError('must set address before %s option' % option)
+    
+    def get_mcu(parser):
+        '''
+        Return MCU handle for the bus and address options, opened
+        on first use. Goes through the daemon if it is running,
+        unless --backend, --model or --trace ask for a bus handle
+        of our own.
+        '''
+        # make sure bus and address are numeric values
+        mcu_bus = '%d' % int(parser.values.bus)
+        mcu_addr = '%x' % int(parser.values.addr)
+        key = (mcu_bus, mcu_addr, parser.values.backend)
+        if key not in mcu_handles:
+            mcu = None
+            if not (parser.values.backend or parser.values.model or parser.values.trace):
+                mcu = get_control_client(mcu_bus, mcu_addr)
+            if mcu is None:
+                profile = None
+                if parser.values.model:
+                    profile = get_profile(parser.values.model)
+                mcu = MCUControl(busno=mcu_bus, address=mcu_addr,
+                                 backend=parser.values.backend,
+                                 profile=profile, trace=parser.values.trace)
+            mcu_handles[key] = mcu
+        return mcu_handles[key]
+    
+    def read_cached(parser, cmd):
+        '''
+        Return value of cmd the daemon published in state_file.
+        Values older than STATE_MAX_AGE check intervals of the MCU
+        are refused, the daemon having died or lost the bus.
+        '''
+        if not __mcu_settings__.state_file:
+            raise IOError(errno.ENOENT, 'state_file is not set in %s' % CONFIG_FILE)
+        profile = get_profile(parser.values.model or __mcu_settings__.mcu_model)
+        if cmd not in profile.read_commands:
+            raise ValueError('Command not found: %s' % cmd)
+        cmd_value = profile.read_commands[cmd]
+        state = StateFile(__mcu_settings__.state_file, readonly=True)
+        try:
+            values = state.read(int(parser.values.bus), int(parser.values.addr),
+                                [cmd_value])
+        finally:
+            state.close()
+        if cmd_value not in values:
+            raise ValueError('daemon has not published %s of 0x%02x on bus %d' \
+                             % (cmd, int(parser.values.addr), int(parser.values.bus)))
+        value, timestamp = values[cmd_value]
+        interval = __mcu_settings__.check_interval
+        for target_settings in __mcu_settings__.targets:
+            if (target_settings.mcu_bus, target_settings.mcu_address) == \
+                    (int(parser.values.bus), int(parser.values.addr)):
+                interval = target_settings.check_interval
+        age = time.time() - timestamp
+        if age > STATE_MAX_AGE * interval:
+            raise ValueError('%s of 0x%02x on bus %d was published %d seconds ago, '
+                             'is the daemon running?' \
+                             % (cmd, int(parser.values.addr), int(parser.values.bus), age))
+        return value
+    
+    def report(parser, op, cmd, value):
+        '''
+        Print result of a read or write, or keep it for
+        print_results() if the output format is json or csv
+        '''
+        if parser.values.format == 'text':
+            if op == 'read':
+                print 'Read %s: %d (0x%02x)' % (cmd, value, value)
+            elif op == 'write':
+                print 'Wrote %s: %d (0x%02x)' % (cmd, value, value)
+            else:
+                print '%-14s %3d (0x%02x)' % (cmd, value, value)
+            return
+        results.append({'bus' : int(parser.values.bus),
+                        'address' : '0x%02x' % int(parser.values.addr),
+                        'op' : op, 'command' : cmd, 'value' : value})
+    
+    def print_results(format):
+        '''
+        Print results kept by report() as json or csv
+        '''
+        fields = ('bus', 'address', 'op', 'command', 'value', 'message')
+        if format == 'json':
+            import json
+            print json.dumps(results, indent=1, sort_keys=True)
+        elif format == 'csv':
+            import csv
+            writer = csv.writer(sys.stdout)
+            writer.writerow(fields)
+            for result in results:
+                writer.writerow([result.get(field, '') for field in fields])
+    
+    def fail(parser, e):
+        '''
+        Report error e and exit. In json and csv output the error is
+        the last result, after those of the options which succeeded.
+        '''
+        __mcu_logger__.debug(str(e))
+        if parser.values.format == 'text':
+            print e
+        else:
+            results.append({'op' : 'error', 'message' : str(e)})
+            print_results(parser.values.format)
+        sys.exit(1)
+    
+    def commit_writes(mcu, writes):
+        '''
+        Issue writes back-to-back, verifying the PWM range once
+        '''
+        if isinstance(mcu, ControlClient):
+            mcu.batch(writes)
+        else:
+            with mcu.batch(verify=VERIFY_COMMIT) as batch:
+                for cmd, value in writes:
+                    batch.write_byte(cmd, value)
+    
+    def run_operations(parser):
+        '''
+        Run the queued operations in command line order, each on the
+        bus and address given before it
+        '''
+        for run, option, opt_str, value, bus, addr in operations:
+            parser.values.bus, parser.values.addr = bus, addr
+            try:
+                run(option, opt_str, value, parser)
+            except OptionValueError, e:
+                parser.error(str(e))
+    
+    #
+    # optpars callback functions
+    #
+    def queue_callback(option, opt_str, value, parser, run):
+        '''
+        Queue an operation for run_operations(), so --format,
+        --cached, --backend, --model and --trace apply to it
+        wherever they are given
+        '''
+        check_target(parser, option.get_opt_string().lstrip('-'))
+        operations.append((run, option, opt_str, value,
+                           parser.values.bus, parser.values.addr))
+    
+    def read_mcu_callback(option, opt_str, value, parser):
+        '''
+        Validate arguments, and process read command
+        '''
+        check_target(parser, 'read')
+        try:
+            if parser.values.cached:
+                retval = read_cached(parser, value)
+            else:
+                retval = get_mcu(parser).read_byte(value)
+            report(parser, 'read', value, retval)
+        except Exception, e:
+            fail(parser, e)
+    
+    def snapshot_mcu_callback(option, opt_str, value, parser):
+        '''
+        Validate arguments, and read all registers together
+        '''
+        check_target(parser, 'snapshot')
+        try:
+            snapshot = get_mcu(parser).snapshot()
+            for name in snapshot.names():
+                report(parser, 'snapshot', name, snapshot[name])
+        except Exception, e:
+            fail(parser, e)
+    
+    def write_mcu_callback(option, opt_str, value, parser):
+        '''
+        Validate arguments, and process write command
+        '''
+        check_target(parser, 'write')
+        try:
+            get_mcu(parser).write_byte(value[0], value[1])
+            report(parser, 'write', value[0], int(value[1]))
+        except Exception, e:
+            fail(parser, e)
+    
+    def script_callback(option, opt_str, value, parser):
+        '''
+        Run read, write and snapshot commands from file value, one
+        per line, or from stdin if value is -. Consecutive writes
+        are issued back-to-back, and the PWM range is verified once
+        after them. Lines starting with # are ignored.
+        '''
+        check_target(parser, 'script')
+        if value == '-':
+            lines = sys.stdin.readlines()
+        else:
+            try:
+                f = open(value)
+                try:
+                    lines = f.readlines()
+                finally:
+                    f.close()
+            except IOError, e:
+                fail(parser, e)
+        
+        writes = []
+        lineno = 0
+        try:
+            mcu = get_mcu(parser)
+            for line in lines:
+                lineno += 1
+                args = line.split()
+                if not args or args[0].startswith('#'):
+                    continue
+                if args[0] == 'write' and len(args) == 3:
+                    writes.append((args[1], int(args[2])))
+                    continue
+                # queued writes are issued before the next read
+                if writes:
+                    commit_writes(mcu, writes)
+                    for cmd, val in writes:
+                        report(parser, 'write', cmd, val)
+                    writes = []
+                if args[0] == 'read' and len(args) == 2:
+                    report(parser, 'read', args[1], mcu.read_byte(args[1]))
+                elif args[0] == 'snapshot':
+                    snapshot = mcu.snapshot(args[1:] or SNAPSHOT_REGISTERS)
+                    for name in snapshot.names():
+                        report(parser, 'snapshot', name, snapshot[name])
+                else:
+                    raise ValueError('invalid command: %s' % line.strip())
+            if writes:
+                commit_writes(mcu, writes)
+                for cmd, val in writes:
+                    report(parser, 'write', cmd, val)
+        except Exception, e:
+            fail(parser, '%s:%d: %s' % (value, lineno, e))
+    
+    def ramp_mcu_callback(option, opt_str, value, parser):
+        '''
+        Validate arguments, and fade brightness
+        '''
+        check_target(parser, 'ramp')
+        try:
+            target, duration = int(value[0]), float(value[1])
+            mcu = get_mcu(parser)
+            if isinstance(mcu, ControlClient):
+                mcu.ramp_brightness(target, duration)
+            else:
+                mcu.ramp_brightness(target, duration,
+                                    __mcu_settings__.ramp_max_rate,
+                                    __mcu_settings__.brightness_step)
+            print 'Fading brightness to %d over %.1f seconds' % (target, duration)
+        except ValueError, e:
+            raise OptionValueError('invalid ramp arguments %s: %s' % (' '.join(value), e))
+        except Exception, e:
+            fail(parser, e)
+    
+    def history_callback(option, opt_str, value, parser):
+        '''
+        Dump or aggregate the telemetry samples of the last
+        value seconds
+        '''
+        if not __mcu_settings__.telemetry_file:
+            raise OptionValueError('telemetry_file is not set in %s' % CONFIG_FILE)
+        try:
+            ring = TelemetryRing(0, __mcu_settings__.telemetry_file, readonly=True)
+            since = time.time() - value
+            if parser.values.aggregate:
+                stats = ring.aggregate(since)
+                keys = stats.keys()
+                keys.sort()
+                print '%-4s %-7s %-8s %8s %5s %5s %7s %10s' \
+                      % ('bus', 'address', 'register', 'samples', 'min', 'max', 'avg', 'corrective')
+                for key in keys:
+                    samples, low, high, total, corrective = stats[key]
+                    print '%-4d 0x%02x    0x%02x     %8d %5d %5d %7.1f %10d' \
+                          % (key + (samples, low, high, float(total) / samples, corrective))
+            else:
+                for timestamp, bus, address, register, val, flags in ring.records(since):
+                    print '%s.%03d %d 0x%02x 0x%02x %3d%s%s' \
+                          % (time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp)),
+                             int(timestamp * 1000) % 1000, bus, address, register, val,
+                             flags & TELEMETRY_WRITE and ' write' or '',
+                             flags & TELEMETRY_CORRECTIVE and ' corrective' or '')
+            ring.close()
+        except (IOError, OSError), e:
+            print e
+            sys.exit(1)
+    
+    def trace_callback(option, opt_str, value, parser):
+        '''
+        Open the trace file transactions are appended to
+        '''
+        try:
+            parser.values.trace = TraceFile(value)
+        except (IOError, OSError), e:
+            raise OptionValueError('can not trace to %s: %s' % (value, e))
+    
+    def profile_callback(option, opt_str, value, parser):
+        '''
+        Profile the options following --profile
+        '''
+        parser.values.profile = value
+        profiler = Profiler(value, parser.values.profile_every)
+        profiler.start()
+        profiling.append(profiler)
+    
+    def daemon_callback(option, opt_str, value, parser):
+        '''
+        This callback method controls the start, stop and restart
+        commands from optparse to the daemon.
+        '''
+        # create the daemon instance
+        daemon = Daemon(__mcu_settings__.pidfile)
+        if parser.values.profile:
+            # the daemon profiles its poll cycles, not this process
+            for profiler in profiling:
+                profiler.stop()
+            del profiling[:]
+            daemon.profile_file = parser.values.profile
+            daemon.profile_every = parser.values.profile_every
+        try:
+            if value == 'start':
                 print 'Trying to start daemon...'
                 daemon.start()
             elif value == 'stop':
@@ -560,20 +4863,79 @@ or writing byte data.'''
     parser.add_option('-a', '--address', type='int',
           dest='addr', action='store',
           help='MCU address. Can be hex(0x34) or decimal(52)')
+    parser.add_option('--backend', type='choice', choices=['smbus', 'sim'],
+          dest='backend', action='store', help='bus backend. smbus for \
+                  the real bus, sim for a simulated MCU. Defaults to \
+                  bus_backend from mcuctrl.conf. When given, a running \
+                  daemon is not used')
+    parser.add_option('--model', type='string', dest='model',
+          action='store', metavar='MODEL', help='MCU model: afl-408b, \
+                  or a model profile file. Defaults to mcu_model from \
+                  mcuctrl.conf')
     parser.add_option('-r', '--read', type='string',
-          dest='read', action='callback', callback=read_mcu_callback,
+          dest='read', action='callback', callback=queue_callback,
+          callback_kwargs={'run' : read_mcu_callback},
           help='read MCU option. Valid commands are: \
                   brightness, volume, fw, fwtype, flag, backlight,\
                   rdname, function, luxmode, change_status,\
                   pwm_min, pwm_max. All values are read out \
                   in decimal numbers')
+    parser.add_option('--cached', action='store_true', dest='cached',
+          default=False, help='read values the daemon published in \
+                  state_file instead of reading the bus. Values not \
+                  refreshed for %d check intervals are refused' % STATE_MAX_AGE)
+    parser.add_option('-s', '--snapshot', action='callback',
+          callback=queue_callback,
+          callback_kwargs={'run' : snapshot_mcu_callback},
+          help='read brightness, volume, fw, fwtype, flag, backlight, \
+                  luxmode, change_status, pwm_min and pwm_max \
+                  together, in as few transactions as the bus allows')
     parser.add_option('-w', '--write', type='string', nargs=2,
-          dest='write', action='callback', callback=write_mcu_callback,
+          dest='write', action='callback', callback=queue_callback,
+          callback_kwargs={'run' : write_mcu_callback},
           help='write MCU option. Valid commands are: inc_brightness, \
                   dec_brightness, inc_volume, dec_volume, mute, volume, \
                   brightness, inverter, polling, backlight, auto_dimming, \
                   luxmode, keypad_lock, pwm_min, pwm_max. All values must be \
                   decimal(18) numbers')
+    parser.add_option('--script', type='string', dest='script',
+          action='callback', callback=queue_callback,
+          callback_kwargs={'run' : script_callback}, metavar='FILE',
+          help='run read, write and snapshot commands from FILE, one \
+                  per line (read CMD, write CMD VALUE, snapshot [CMD..]). \
+                  - reads commands from stdin. Consecutive writes are \
+                  verified once')
+    parser.add_option('--format', type='choice', dest='format',
+          choices=['text', 'json', 'csv'], default='text',
+          help='output format of read, write, snapshot and script \
+                  results: text, json or csv [default: %default]')
+    parser.add_option('--ramp', type='string', nargs=2,
+          dest='ramp', action='callback', callback=queue_callback,
+          callback_kwargs={'run' : ramp_mcu_callback},
+          metavar='BRIGHTNESS SECONDS',
+          help='fade brightness to BRIGHTNESS over SECONDS, writing at \
+                  most ramp_max_rate times per second')
+    parser.add_option('--aggregate', action='store_true', dest='aggregate',
+          default=False, help='summarize --history per register instead \
+                  of listing samples. Must be set before --history')
+    parser.add_option('--history', type='float', dest='history',
+          action='callback', callback=history_callback, metavar='SECONDS',
+          help='list samples recorded by the daemon in the last SECONDS, \
+                  read from telemetry_file')
+    parser.add_option('--trace', type='string', dest='trace',
+          action='callback', callback=trace_callback, metavar='FILE',
+          help='append the bus transactions of read, write and other \
+                  operations to FILE, for replay by mcubench.py. Transactions made \
+                  by the daemon are traced to its trace_file')
+    parser.add_option('--profile-every', type='int', dest='profile_every',
+          default=1, metavar='N', help='with -d and --profile, profile \
+                  only every N-th poll cycle. Must be set before \
+                  --profile [default: %default]')
+    parser.add_option('--profile', type='string', dest='profile',
+          action='callback', callback=profile_callback, metavar='FILE',
+          help='profile read, write and other operations, or with -d the poll \
+                  cycles of the daemon. Prints where the time went, \
+                  and writes the statistics to FILE for profile viewers')
     daemon_group = OptionGroup(parser, title='Daemon options',
                        description='Control mcuctrl daemon behavior')
     daemon_group.add_option('-d', '--daemon', action='callback',
@@ -583,5 +4945,16 @@ or writing byte data.'''
                          are start, stop, or restart.')
 
     parser.add_option_group(daemon_group)
-    (options, args) = parser.parse_args()
+    try:
+        (options, args) = parser.parse_args()
+        run_operations(parser)
+        print_results(options.format)
+    finally:
+        for profiler in profiling:
+            profiler.stop()
+            sys.stderr.write(profiler.summary())
+            try:
+                profiler.dump()
+            except (IOError, OSError), e:
+                sys.stderr.write('could not write profile: %s\n' % e)
     